@@ -2,30 +2,39 @@ import csv
 import os
 from collections import defaultdict
 
+from schema_colonne import schema_per_intestazione
+
 csv_files = [f for f in os.listdir('.') if f.endswith('.csv')]
-file_columns = {}
+file_schemas = {}
 
 for file in csv_files:
-    with open(file, 'r', encoding='utf-8-sig') as f:
+    with open(file, 'r', newline='', encoding='utf-8-sig') as f:
         reader = csv.reader(f)
         headers = next(reader, None)
         if headers:
-            headers = [h.strip() for h in headers if h.strip()]
-            file_columns[file] = headers
+            file_schemas[file] = schema_per_intestazione(headers)
+
+file_columns = {file: list(schema.nomi) for file, schema in file_schemas.items()}
 
-columns_to_files = defaultdict(list)
-for file, columns in file_columns.items():
-    columns_key = tuple(columns)
-    columns_to_files[columns_key].append(file)
+# Stessi nomi di colonna (senza spazi e colonne vuote) = stessa struttura
+schema_to_files = defaultdict(list)
+for file, schema in file_schemas.items():
+    schema_to_files[schema.nomi].append(file)
 
 print(f"Totale file CSV analizzati: {len(csv_files)}\n")
-print(f"Numero di strutture di colonne diverse trovate: {len(columns_to_files)}\n")
+print(f"Numero di strutture di colonne diverse trovate: {len(schema_to_files)}\n")
 
-for i, (columns, files) in enumerate(columns_to_files.items(), 1):
+for i, (columns, files) in enumerate(schema_to_files.items(), 1):
+    schema = file_schemas[files[0]]
     print(f"\n{'='*80}")
     print(f"GRUPPO {i} - {len(files)} file con questa struttura:")
     print(f"{'='*80}")
     print(f"Colonne: {list(columns)}")
+    print("\nPiano di lettura:")
+    for riga in schema.descrizione():
+        print(f"  {riga}")
+    if not schema.colonne_comune:
+        print("  ⚠️  Nessuna colonna COMUNE: le righe di questi file verranno ignorate")
     print(f"\nFile:")
     for file in sorted(files):
         print(f"  - {file}")
@@ -41,4 +50,4 @@ for file, columns in sorted(file_columns.items()):
         print(f"\n{file}:")
         print(f"  Numero colonne: {len(columns)}")
         if extra_cols:
-            print(f"  Colonne aggiuntive: {extra_cols}")
\ No newline at end of file
+            print(f"  Colonne aggiuntive: {extra_cols}")
@@ -0,0 +1,110 @@
+"""
+Registro degli schemi delle intestazioni dei CSV dei comuni.
+
+La classificazione delle colonne (comune, provincia, email e tipo di email)
+dipende solo dall'intestazione: ogni intestazione distinta viene compilata
+una sola volta in un piano indice colonna → ruolo, riutilizzato per tutte le
+righe e per tutti i file con la stessa struttura.
+"""
+
+import hashlib
+import re
+
+ANNO_RE = re.compile(r'202[0-9]')
+
+
+def ha_anno_in_intestazione(nome_colonna):
+    """Verifica se il nome della colonna contiene un anno (2020-2029)"""
+    return bool(ANNO_RE.search(nome_colonna.lower()))
+
+def è_colonna_provincia(nome_colonna):
+    """Verifica se è una colonna relativa alla provincia"""
+    nome_upper = nome_colonna.strip().upper()
+    return nome_upper in ['PR', 'CR', '6', ''] or nome_upper == 'CONTEGGIO'
+
+def è_colonna_email(nome_colonna):
+    """Verifica se è una colonna email valida"""
+    nome_lower = nome_colonna.lower()
+    keywords = ['mail', 'email', 'pec']
+    return any(keyword in nome_lower for keyword in keywords) and not ha_anno_in_intestazione(nome_colonna)
+
+def normalizza_tipo_email(nome_colonna):
+    """Categorizza il tipo di email"""
+    nome_lower = nome_colonna.lower()
+
+    if 'generic' in nome_lower or 'segreteria' in nome_lower or 'protocollo' in nome_lower or 'sindaco' in nome_lower or 'info' in nome_lower:
+        return 'generica'
+    elif 'biblioteca' in nome_lower or 'biblio' in nome_lower:
+        return 'biblioteca'
+    elif 'cultur' in nome_lower or 'turism' in nome_lower or 'scuola' in nome_lower or 'sport' in nome_lower or 'tempo' in nome_lower or 'specific' in nome_lower or 'eventi' in nome_lower:
+        return 'specifica'
+    elif "chi e'" in nome_lower:
+        return 'skip'
+    elif 'altro' in nome_lower or nome_lower == 'mail':
+        return 'altro'
+    else:
+        return 'altro'
+
+
+class SchemaColonne:
+    """Piano compilato di un'intestazione: per ogni colonna usata, indice e ruolo.
+
+    - `colonne_comune`: indici delle colonne COMUNE (vince l'ultima non vuota)
+    - `colonne_email`: coppie (indice, tipo email) nell'ordine delle colonne
+    - `ruoli`: (nome, ruolo, tipo) per ogni colonna, per i report
+    """
+
+    def __init__(self, intestazione):
+        self.intestazione = tuple(intestazione)
+        self.fingerprint = hashlib.sha1('\x1f'.join(self.intestazione).encode('utf-8')).hexdigest()[:12]
+        self.colonne_comune = []
+        self.colonne_email = []
+        self.ruoli = []
+
+        # Come csv.DictReader: con nomi ripetuti vale l'ultima colonna,
+        # nella posizione della prima occorrenza
+        posizioni = {}
+        for indice, nome in enumerate(self.intestazione):
+            posizioni[nome] = indice
+
+        for nome, indice in posizioni.items():
+            if not nome:
+                continue
+            col_clean = nome.strip()
+            if è_colonna_provincia(col_clean):
+                self.ruoli.append((col_clean, 'provincia', None))
+            elif 'COMUNE' in col_clean.upper():
+                self.colonne_comune.append(indice)
+                self.ruoli.append((col_clean, 'comune', None))
+            elif è_colonna_email(col_clean):
+                tipo = normalizza_tipo_email(col_clean)
+                if tipo != 'skip':
+                    self.colonne_email.append((indice, tipo))
+                self.ruoli.append((col_clean, 'email', tipo))
+            else:
+                self.ruoli.append((col_clean, 'ignorata', None))
+
+    @property
+    def nomi(self):
+        """Nomi delle colonne non vuote (senza spazi ai lati)"""
+        return tuple(h.strip() for h in self.intestazione if h.strip())
+
+    def descrizione(self):
+        """Piano in forma leggibile, es. ['COMUNE → comune', 'MAIL GENERICA → email/generica']"""
+        righe = []
+        for nome, ruolo, tipo in self.ruoli:
+            righe.append(f"{nome} → {ruolo}/{tipo}" if tipo else f"{nome} → {ruolo}")
+        return righe
+
+
+# Schemi compilati per intestazione (uno per struttura di colonne distinta)
+REGISTRO = {}
+
+
+def schema_per_intestazione(intestazione):
+    """Ritorna lo schema compilato dell'intestazione, compilandolo alla prima richiesta"""
+    chiave = tuple(intestazione)
+    schema = REGISTRO.get(chiave)
+    if schema is None:
+        schema = REGISTRO[chiave] = SchemaColonne(chiave)
+    return schema
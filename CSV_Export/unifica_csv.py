@@ -1,6 +1,17 @@
+import argparse
 import csv
+import hashlib
+import heapq
+import json
 import os
 import re
+import tempfile
+import unicodedata
+from array import array
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+from schema_colonne import schema_per_intestazione
 
 def estrai_provincia_da_nome_file(nome_file):
     """Estrae il nome della provincia dal nome del file CSV"""
@@ -36,38 +47,6 @@ def estrai_provincia_da_nome_file(nome_file):
     nome_clean = nome.replace('.csv', '')
     return mapping_nomi.get(nome_clean, nome_clean)
 
-def ha_anno_in_intestazione(nome_colonna):
-    """Verifica se il nome della colonna contiene un anno (2020-2029)"""
-    return bool(re.search(r'202[0-9]', nome_colonna.lower()))
-
-def è_colonna_provincia(nome_colonna):
-    """Verifica se è una colonna relativa alla provincia"""
-    nome_upper = nome_colonna.strip().upper()
-    return nome_upper in ['PR', 'CR', '6', ''] or nome_upper == 'CONTEGGIO'
-
-def è_colonna_email(nome_colonna):
-    """Verifica se è una colonna email valida"""
-    nome_lower = nome_colonna.lower()
-    keywords = ['mail', 'email', 'pec']
-    return any(keyword in nome_lower for keyword in keywords) and not ha_anno_in_intestazione(nome_colonna)
-
-def normalizza_tipo_email(nome_colonna):
-    """Categorizza il tipo di email"""
-    nome_lower = nome_colonna.lower()
-    
-    if 'generic' in nome_lower or 'segreteria' in nome_lower or 'protocollo' in nome_lower or 'sindaco' in nome_lower or 'info' in nome_lower:
-        return 'generica'
-    elif 'biblioteca' in nome_lower or 'biblio' in nome_lower:
-        return 'biblioteca'
-    elif 'cultur' in nome_lower or 'turism' in nome_lower or 'scuola' in nome_lower or 'sport' in nome_lower or 'tempo' in nome_lower or 'specific' in nome_lower or 'eventi' in nome_lower:
-        return 'specifica'
-    elif "chi e'" in nome_lower:
-        return 'skip'
-    elif 'altro' in nome_lower or nome_lower == 'mail':
-        return 'altro'
-    else:
-        return 'altro'
-
 def pulisci_email(email):
     """Pulisce e valida un indirizzo email"""
     if not email:
@@ -77,13 +56,14 @@ def pulisci_email(email):
         return email
     return ''
 
+# Tipi di email in ordine di priorità
+PRIORITA_EMAIL = ['generica', 'biblioteca', 'specifica', 'altro']
+
 def ottieni_email_prioritarie(emails_dict, max_emails=3):
     """Seleziona fino a 3 email con priorità: generica, biblioteca, specifica, altro"""
     result = []
     
-    priorita = ['generica', 'biblioteca', 'specifica', 'altro']
-    
-    for tipo in priorita:
+    for tipo in PRIORITA_EMAIL:
         if tipo in emails_dict and emails_dict[tipo]:
             for email in emails_dict[tipo]:
                 if email and email not in result:
@@ -93,80 +73,435 @@ def ottieni_email_prioritarie(emails_dict, max_emails=3):
     
     return result
 
-csv_files = [f for f in os.listdir('.') if f.endswith('.csv') and f not in ['analizza_colonne.py', 'unifica_csv.py']]
+FIELDNAMES = ['provincia', 'comune', 'email_1', 'email_2', 'email_3']
+
+# Nei run si conserva anche il tipo di ogni email, per riapplicare la priorità nelle fusioni,
+# e il nome del comune normalizzato (chiave della deduplica), calcolato una volta per file
+RUN_FIELDNAMES = FIELDNAMES + ['tipi', 'chiave']
+
+REPORT_FIELDNAMES = ['motivo', 'provincia', 'comune', 'email_1', 'email_2', 'email_3',
+                     'unito_a_provincia', 'unito_a_comune', 'unito_a_email_1']
+
+# Record per run ordinato: oltre questa soglia il run viene scritto su disco
+RUN_SIZE = 50000
+
+# Run aperti contemporaneamente durante il merge (oltre si fa un merge a più passate)
+MERGE_FAN_IN = 64
+
+
+def chiave_ordinamento(record):
+    return (record['provincia'], record['comune'])
 
-all_records = []
 
-for file in csv_files:
-    provincia = estrai_provincia_da_nome_file(file)
-    print(f"Processando {file} (Provincia: {provincia})")
+def estrai_record(row, provincia, schema):
+    """Ricava (comune, email prioritarie) da una riga (lista) secondo lo schema compilato"""
+    n = len(row)
+    comune = None
+    for indice in schema.colonne_comune:
+        value = row[indice] if indice < n else None
+        if value:
+            comune = value.strip()
     
+    if not comune:
+        return None
+    
+    emails_by_type = {}
+    for indice, tipo in schema.colonne_email:
+        value = row[indice] if indice < n else None
+        if not value:
+            continue
+        email_clean = pulisci_email(value)
+        if email_clean:
+            if tipo not in emails_by_type:
+                emails_by_type[tipo] = []
+            if email_clean not in emails_by_type[tipo]:
+                emails_by_type[tipo].append(email_clean)
+    
+    return crea_record(provincia, comune, emails_by_type)
+
+
+def crea_record(provincia, comune, emails_by_type):
+    """Record di output con le email prioritarie e il loro tipo (campo `tipi`)"""
+    email_list = ottieni_email_prioritarie(emails_by_type)
+    tipo_di = {}
+    for tipo in PRIORITA_EMAIL:
+        for email in emails_by_type.get(tipo, []):
+            tipo_di.setdefault(email, tipo)
+    return {
+        'provincia': provincia,
+        'comune': comune,
+        'email_1': email_list[0] if len(email_list) > 0 else '',
+        'email_2': email_list[1] if len(email_list) > 1 else '',
+        'email_3': email_list[2] if len(email_list) > 2 else '',
+        'tipi': ','.join(tipo_di[email] for email in email_list)
+    }
+
+
+def scrivi_run(records, run_dir, prefisso, numero):
+    """Ordina un blocco di record e lo scrive su disco come run"""
+    records.sort(key=chiave_ordinamento)
+    path = os.path.join(run_dir, f'{prefisso}_{numero:04d}.csv')
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=RUN_FIELDNAMES)
+        writer.writerows(records)
+    return path
+
+
+def leggi_run(path):
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        # csv.reader + zip: più rapido di DictReader, i run sono scritti da noi
+        for row in csv.reader(f):
+            yield dict(zip(RUN_FIELDNAMES, row))
+
+
+def elabora_file(prefisso, file, run_dir, run_size=RUN_SIZE, dedup_file=True):
+    """Legge un CSV in streaming e lo scrive in run ordinati (eseguito in un processo del pool).
+
+    Con `dedup_file` i comuni ripetuti nello stesso file vengono scartati
+    (senza deduplica globale); altrimenti ci pensa deduplica().
+    Ritorna (file, provincia, run, numero di record).
+    """
+    provincia = estrai_provincia_da_nome_file(os.path.basename(file))
+    runs = []
+    buffer = []
+    totale = 0
     duplicati_check = set()
     
-    with open(file, 'r', encoding='utf-8-sig') as f:
-        reader = csv.DictReader(f)
+    with open(file, 'r', newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        # Colonne classificate una volta sola per intestazione
+        schema = schema_per_intestazione(next(reader, []))
         
         for row in reader:
-            comune = None
-            emails_by_type = {}
+            if not row:
+                continue
+            record = estrai_record(row, provincia, schema)
+            if not record:
+                continue
             
-            for col_name, value in row.items():
-                if not col_name or not value:
+            if dedup_file:
+                chiave = f"{provincia}_{record['comune']}"
+                if chiave in duplicati_check:
                     continue
-                    
-                col_clean = col_name.strip()
-                
-                if è_colonna_provincia(col_clean):
-                    continue
-                
-                if 'COMUNE' in col_clean.upper():
-                    comune = value.strip()
-                elif è_colonna_email(col_clean):
-                    tipo = normalizza_tipo_email(col_clean)
-                    if tipo != 'skip':
-                        email_clean = pulisci_email(value)
-                        if email_clean:
-                            if tipo not in emails_by_type:
-                                emails_by_type[tipo] = []
-                            if email_clean not in emails_by_type[tipo]:
-                                emails_by_type[tipo].append(email_clean)
+                duplicati_check.add(chiave)
             
-            if comune:
-                chiave = f"{provincia}_{comune}"
-                if chiave not in duplicati_check:
-                    duplicati_check.add(chiave)
-                    
-                    email_list = ottieni_email_prioritarie(emails_by_type)
-                    
-                    email1 = email_list[0] if len(email_list) > 0 else ''
-                    email2 = email_list[1] if len(email_list) > 1 else ''
-                    email3 = email_list[2] if len(email_list) > 2 else ''
-                    
-                    all_records.append({
-                        'provincia': provincia,
-                        'comune': comune,
-                        'email_1': email1,
-                        'email_2': email2,
-                        'email_3': email3
-                    })
-
-all_records.sort(key=lambda x: (x['provincia'], x['comune']))
-
-output_file = 'contatti_unificati.csv'
-with open(output_file, 'w', newline='', encoding='utf-8-sig') as f:
-    fieldnames = ['provincia', 'comune', 'email_1', 'email_2', 'email_3']
-    writer = csv.DictWriter(f, fieldnames=fieldnames)
-    writer.writeheader()
-    writer.writerows(all_records)
-
-print(f"\n✓ File unificato creato: {output_file}")
-print(f"  Totale record: {len(all_records)}")
-
-provincia_count = {}
-for record in all_records:
-    prov = record['provincia']
-    provincia_count[prov] = provincia_count.get(prov, 0) + 1
-
-print("\nRecord per provincia:")
-for prov in sorted(provincia_count.keys()):
-    print(f"  {prov}: {provincia_count[prov]} comuni")
\ No newline at end of file
+            record['chiave'] = normalizza_chiave(record['comune'])
+            buffer.append(record)
+            totale += 1
+            if len(buffer) >= run_size:
+                runs.append(scrivi_run(buffer, run_dir, prefisso, len(runs)))
+                buffer = []
+    
+    if buffer:
+        runs.append(scrivi_run(buffer, run_dir, prefisso, len(runs)))
+    return file, provincia, runs, totale
+
+
+def unisci_run(runs, run_dir):
+    """Riduce i run a un numero gestibile unendoli a gruppi di MERGE_FAN_IN.
+
+    I gruppi sono consecutivi, così a parità di chiave resta l'ordine dei file.
+    Vengono rimossi solo i run intermedi creati qui, non quelli della cache.
+    """
+    passata = 0
+    while len(runs) > MERGE_FAN_IN:
+        passata += 1
+        uniti = []
+        for i in range(0, len(runs), MERGE_FAN_IN):
+            gruppo = runs[i:i + MERGE_FAN_IN]
+            path = os.path.join(run_dir, f'merge_{passata:02d}_{i // MERGE_FAN_IN:05d}.csv')
+            with open(path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=RUN_FIELDNAMES)
+                writer.writerows(heapq.merge(*(leggi_run(r) for r in gruppo), key=chiave_ordinamento))
+            if passata > 1:
+                for r in gruppo:
+                    os.remove(r)
+            uniti.append(path)
+        runs = uniti
+    return runs
+
+
+# Versione del formato dei run in cache: cambiarla quando cambia l'estrazione dei record
+CACHE_VERSION = 1
+MANIFEST = 'manifest.json'
+RUN_CACHE_RE = re.compile(r'^[0-9a-f]{16}_\d{4}\.csv$')
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for blocco in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(blocco)
+    return h.hexdigest()
+
+
+class CacheRun:
+    """Run ordinati per file conservati tra un'esecuzione e l'altra.
+
+    Il manifest registra per ogni CSV di input dimensione, mtime, hash del
+    contenuto e run prodotti: un file con dimensione e mtime invariati non
+    viene nemmeno riletto; se cambiano ma l'hash è lo stesso basta
+    aggiornare il manifest. Solo i file nuovi o modificati vengono rielaborati.
+    """
+
+    def __init__(self, cartella):
+        self.cartella = cartella
+        self.path = os.path.join(cartella, MANIFEST)
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('versione') == CACHE_VERSION:
+                self.files = manifest.get('files', {})
+        os.makedirs(cartella, exist_ok=True)
+
+    def valida(self, file, dedup_file):
+        """Voce del manifest ancora valida per `file`, altrimenti None.
+
+        Ritorna anche l'hash calcolato (se è stato necessario), per il prefisso dei nuovi run.
+        """
+        nome = os.path.basename(file)
+        stat = os.stat(file)
+        voce = self.files.get(nome)
+        if voce and (voce['dedup_file'] != dedup_file
+                     or not all(os.path.exists(os.path.join(self.cartella, r)) for r in voce['runs'])):
+            voce = None
+        if voce and voce['size'] == stat.st_size and voce['mtime_ns'] == stat.st_mtime_ns:
+            return voce, voce['sha256']
+        sha256 = hash_file(file)
+        if voce and voce['sha256'] == sha256:
+            voce.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            return voce, sha256
+        return None, sha256
+
+    def prefisso(self, file, sha256):
+        """Prefisso dei run: dipende da nome (provincia) e contenuto del file"""
+        return hashlib.sha1(f'{os.path.basename(file)}\0{sha256}'.encode('utf-8')).hexdigest()[:16]
+
+    def registra(self, file, sha256, dedup_file, provincia, runs, totale):
+        stat = os.stat(file)
+        self.files[os.path.basename(file)] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': sha256,
+            'dedup_file': dedup_file,
+            'provincia': provincia,
+            'runs': [os.path.basename(r) for r in runs],
+            'totale': totale,
+        }
+
+    def runs(self, file):
+        return [os.path.join(self.cartella, r) for r in self.files[os.path.basename(file)]['runs']]
+
+    def salva(self, nomi_file):
+        """Scrive il manifest (solo i file ancora presenti) e rimuove i run non più usati"""
+        self.files = {nome: voce for nome, voce in self.files.items() if nome in nomi_file}
+        usati = {r for voce in self.files.values() for r in voce['runs']}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'versione': CACHE_VERSION, 'files': self.files}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+        for nome in os.listdir(self.cartella):
+            if RUN_CACHE_RE.match(nome) and nome not in usati:
+                os.remove(os.path.join(self.cartella, nome))
+
+
+def normalizza_chiave(testo):
+    """Minuscolo, senza accenti né punteggiatura: "Barzano'" e "Barzanò" coincidono"""
+    testo = unicodedata.normalize('NFKD', testo.casefold())
+    testo = ''.join(c if c.isalnum() else ' ' for c in testo if not unicodedata.combining(c))
+    return ' '.join(testo.split())
+
+
+@lru_cache(maxsize=None)
+def normalizza_provincia(provincia):
+    return normalizza_chiave(provincia)
+
+
+def chiavi_duplicato(record):
+    """Chiavi dell'indice globale: (provincia, comune) normalizzati ed email primaria.
+
+    Le email secondarie non sono chiavi: spesso sono condivise tra comuni
+    diversi (unioni di comuni, sistemi bibliotecari) e li fonderebbero.
+    """
+    chiavi = [('comune', normalizza_provincia(record['provincia']), record['chiave'])]
+    if record['email_1']:
+        chiavi.append(('email', record['email_1'].strip().lower()))
+    return chiavi
+
+
+def trova(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def deduplica(merged_path, output_file, report_file):
+    """Fonde i record duplicati del file ordinato `merged_path` e scrive l'output.
+
+    Tre letture sequenziali: la prima costruisce l'indice globale
+    (chiave → primo record) e unisce i duplicati (union-find, la radice è il
+    primo record in ordine); la seconda raccoglie le email dei gruppi con più
+    record; la terza scrive un record per gruppo, nella posizione del primo,
+    con le email scelte da ottieni_email_prioritarie. In memoria restano solo
+    l'indice e i gruppi duplicati, non i record.
+    """
+    indice = {}
+    parent = array('l')
+    motivi = {}
+    for i, record in enumerate(leggi_run(merged_path)):
+        parent.append(i)
+        for chiave in chiavi_duplicato(record):
+            primo = indice.setdefault(chiave, i)
+            if primo == i:
+                continue
+            a, b = trova(parent, primo), trova(parent, i)
+            if a != b:
+                # La radice più recente confluisce in quella più vecchia
+                parent[max(a, b)] = min(a, b)
+                motivi[max(a, b)] = chiave[0]
+    
+    # Email dei gruppi con più record, nell'ordine dei record
+    radici_duplicate = {trova(parent, i) for i in motivi}
+    gruppi = {}
+    for i, record in enumerate(leggi_run(merged_path)):
+        radice = trova(parent, i)
+        if radice in radici_duplicate:
+            gruppi.setdefault(radice, []).append(record)
+    
+    provincia_count = {}
+    totale = 0
+    duplicati = 0
+    with open(output_file, 'w', newline='', encoding='utf-8-sig') as f, \
+            open(report_file, 'w', newline='', encoding='utf-8-sig') as r:
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES, extrasaction='ignore')
+        writer.writeheader()
+        report = csv.DictWriter(r, fieldnames=REPORT_FIELDNAMES, extrasaction='ignore')
+        report.writeheader()
+        
+        for i, record in enumerate(leggi_run(merged_path)):
+            radice = trova(parent, i)
+            if radice != i:
+                principale = gruppi[radice][0]
+                duplicati += 1
+                report.writerow(dict(record, motivo=motivi[i],
+                                     unito_a_provincia=principale['provincia'],
+                                     unito_a_comune=principale['comune'],
+                                     unito_a_email_1=principale['email_1']))
+                continue
+            
+            if radice in gruppi:
+                emails_by_type = {}
+                viste = set()
+                for membro in gruppi[radice]:
+                    tipi = membro['tipi'].split(',') if membro['tipi'] else []
+                    for email, tipo in zip((membro['email_1'], membro['email_2'], membro['email_3']), tipi):
+                        if email and email.lower() not in viste:
+                            viste.add(email.lower())
+                            emails_by_type.setdefault(tipo, []).append(email)
+                record = crea_record(record['provincia'], record['comune'], emails_by_type)
+            
+            writer.writerow(record)
+            totale += 1
+            prov = record['provincia']
+            provincia_count[prov] = provincia_count.get(prov, 0) + 1
+    
+    return totale, duplicati, provincia_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Unisce i CSV dei comuni per provincia in un unico file')
+    parser.add_argument('cartella', nargs='?', default='.', help='cartella con i CSV (default: corrente)')
+    parser.add_argument('-o', '--output', default='contatti_unificati.csv', help='file di output')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='processi paralleli (default: numero di CPU)')
+    parser.add_argument('--report', default='duplicati_report.csv',
+                        help='file con i record fusi perché duplicati (default: duplicati_report.csv)')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='nessuna deduplica tra province: scarta solo i comuni ripetuti nello stesso file')
+    parser.add_argument('--cache', default=None,
+                        help='cartella dei run per file riusati tra le esecuzioni (default: <cartella>/.unifica_cache)')
+    parser.add_argument('--no-cache', action='store_true', help='rielabora tutti i file senza usare la cache')
+    args = parser.parse_args()
+    
+    output_file = args.output
+    csv_files = sorted(
+        os.path.join(args.cartella, f) for f in os.listdir(args.cartella)
+        if f.endswith('.csv')
+        and os.path.abspath(os.path.join(args.cartella, f)) not in (os.path.abspath(output_file), os.path.abspath(args.report))
+    )
+    
+    provincia_count = {}
+    totale = 0
+    
+    with tempfile.TemporaryDirectory(prefix='unifica_') as run_dir:
+        dedup_file = args.no_dedup
+        cache = None if args.no_cache else CacheRun(args.cache or os.path.join(args.cartella, '.unifica_cache'))
+        
+        # Solo i file nuovi o modificati vengono riletti
+        da_elaborare = []
+        for i, file in enumerate(csv_files):
+            if cache is None:
+                da_elaborare.append((f'{i:05d}', file, None))
+                continue
+            voce, sha256 = cache.valida(file, dedup_file)
+            if voce:
+                print(f"In cache {os.path.basename(file)} (Provincia: {voce['provincia']}, {voce['totale']} record)")
+            else:
+                da_elaborare.append((cache.prefisso(file, sha256), file, sha256))
+        
+        # Ogni file viene letto e ordinato in un processo separato
+        runs_per_file = {}
+        if da_elaborare:
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                destinazione = run_dir if cache is None else cache.cartella
+                futures = [(sha256, executor.submit(elabora_file, prefisso, file, destinazione, RUN_SIZE, dedup_file))
+                           for prefisso, file, sha256 in da_elaborare]
+                for sha256, future in futures:
+                    file, provincia, file_runs, n = future.result()
+                    print(f"Processato {os.path.basename(file)} (Provincia: {provincia}, {n} record)")
+                    runs_per_file[file] = file_runs
+                    if cache is not None:
+                        cache.registra(file, sha256, dedup_file, provincia, file_runs, n)
+        
+        if cache is not None:
+            cache.salva({os.path.basename(file) for file in csv_files})
+            print(f"\nFile rielaborati: {len(da_elaborare)}/{len(csv_files)} (cache: {cache.cartella})")
+        
+        # Run nell'ordine dei file, come senza cache
+        runs = []
+        for file in csv_files:
+            runs.extend(runs_per_file[file] if file in runs_per_file else cache.runs(file))
+        
+        # Merge k-way dei run ordinati: memoria costante rispetto alla dimensione dell'input
+        runs = unisci_run(runs, run_dir)
+        if args.no_dedup:
+            with open(output_file, 'w', newline='', encoding='utf-8-sig') as f:
+                writer = csv.DictWriter(f, fieldnames=FIELDNAMES, extrasaction='ignore')
+                writer.writeheader()
+                for record in heapq.merge(*(leggi_run(r) for r in runs), key=chiave_ordinamento):
+                    writer.writerow(record)
+                    totale += 1
+                    prov = record['provincia']
+                    provincia_count[prov] = provincia_count.get(prov, 0) + 1
+        else:
+            # Deduplica globale (email primaria e provincia+comune) sul file ordinato completo
+            merged_path = os.path.join(run_dir, 'merged.csv')
+            with open(merged_path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=RUN_FIELDNAMES)
+                writer.writerows(heapq.merge(*(leggi_run(r) for r in runs), key=chiave_ordinamento))
+            totale, duplicati, provincia_count = deduplica(merged_path, output_file, args.report)
+    
+    print(f"\n✓ File unificato creato: {output_file}")
+    print(f"  Totale record: {totale}")
+    if not args.no_dedup:
+        print(f"  Duplicati fusi: {duplicati} (dettaglio in {args.report})")
+    
+    print("\nRecord per provincia:")
+    for prov in sorted(provincia_count.keys()):
+        print(f"  {prov}: {provincia_count[prov]} comuni")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+Benchmark offline dell'importazione CSV.
+
+Avvia un finto server Notion/OpenAI locale (latenza configurabile, 429
+iniettati, database Comuni generato da un seed), lancia server.py puntato
+sul finto server e importa CSV generati di varie dimensioni tramite
+/parse-and-import. Per ogni dimensione riporta righe/s, latenza per riga
+(p50/p99), chiamate API per riga e picco di memoria del server, in JSON.
+
+Esempio:
+    python benchmark.py --sizes 1000,10000 --latency-ms 30 --rate-limit 0.02 --output bench.json
+"""
+
+import argparse
+import base64
+import csv
+import io
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+COMUNI_DB_ID = 'bench-comuni'
+CONTATTI_DB_ID = 'bench-contatti'
+
+SILLABE = ['ba', 'ro', 'ze', 'no', 'li', 'ca', 'ta', 've', 'mo', 'ga', 'sa', 'pi',
+           'lu', 're', 'do', 'na', 'fi', 'co', 'ma', 'te', 'bo', 'ri', 'vi', 'gli']
+PREFISSI = ['San', 'Santa', 'Monte', 'Castel', 'Villa', 'Borgo', 'Ponte', 'Rocca']
+ACCENTI = ['ò', 'è', 'à', 'ù']
+
+
+# ===== DATI GENERATI =====
+
+class BenchDataset:
+    """Comuni fittizi e relative varianti, generati in modo deterministico dal seed"""
+
+    def __init__(self, seed, n_comuni):
+        rng = random.Random(seed)
+        nomi = set()
+        while len(nomi) < n_comuni:
+            radice = ''.join(rng.choice(SILLABE) for _ in range(rng.randint(2, 4))).capitalize()
+            if rng.random() < 0.15:
+                radice = radice[:-1] + rng.choice(ACCENTI)
+            if rng.random() < 0.2:
+                radice = f'{rng.choice(PREFISSI)} {radice}'
+            nomi.add(radice)
+        self.comuni = [{'id': str(uuid.UUID(int=rng.getrandbits(128))), 'nome': nome}
+                       for nome in sorted(nomi)]
+        # Errori di battitura noti: il finto OpenAI li corregge
+        self.typos = {}
+        self.rng = rng
+
+    def typo(self, nome):
+        """Variante con due lettere sostituite (non risolvibile in modo esatto)"""
+        lettere = list(nome)
+        for _ in range(2):
+            i = self.rng.randrange(len(lettere))
+            if lettere[i].isalpha():
+                lettere[i] = self.rng.choice('qwxzjk')
+        variante = ''.join(lettere)
+        self.typos[variante.lower()] = nome
+        return variante
+
+    def generate_csv(self, rows):
+        """CSV di contatti: 80% comuni esatti, 10% varianti di scrittura,
+        5% errori di battitura, 5% località inesistenti"""
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(['Email', 'Nome', 'Carica', 'Comune', 'Telefono', 'Sito'])
+        rng = self.rng
+        for i in range(rows):
+            comune = rng.choice(self.comuni)['nome']
+            r = rng.random()
+            if r < 0.10:
+                comune = comune.upper() if rng.random() < 0.5 else comune.replace('ò', "o'").lower()
+            elif r < 0.15:
+                comune = self.typo(comune)
+            elif r < 0.20:
+                comune = f'Località {rng.randint(1, 10 ** 6)}'
+            slug = comune.lower().replace(' ', '').replace("'", '')
+            if rng.random() < 0.1:
+                email = f'protocollo{i}@comune.{slug}.it'
+            else:
+                email = f'contatto{i}@example.it'
+            writer.writerow([email, f'Contatto {i}', 'Sindaco', comune,
+                             f'0341 {rng.randint(100000, 999999)}', f'www.{slug}.it'])
+        return out.getvalue().encode('utf-8')
+
+
+# ===== FINTO SERVER NOTION/OPENAI =====
+
+class FakeAPI:
+    """Stato del finto server: configurazione e contatori delle chiamate"""
+
+    def __init__(self, dataset, latency_ms, rate_limit, retry_after):
+        self.dataset = dataset
+        self.latency_ms = latency_ms
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def count(self, key):
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.calls)
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    """Risponde come /v1 di api.notion.com e api.openai.com"""
+
+    protocol_version = 'HTTP/1.1'
+    # Header e body sono scritti separatamente: senza TCP_NODELAY il delayed ACK
+    # aggiungerebbe ~40 ms a ogni risposta keep-alive
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def do_PATCH(self):
+        self.handle_api('PATCH')
+
+    def handle_api(self, method):
+        api = self.server.api
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}') if length else {}
+        path = urllib.parse.urlsplit(self.path).path
+
+        if api.latency_ms:
+            time.sleep(api.latency_ms * random.uniform(0.5, 1.5) / 1000)
+
+        if api.rate_limit and random.random() < api.rate_limit:
+            api.count('http_429')
+            self.send_json({'object': 'error', 'code': 'rate_limited'}, 429,
+                           {'Retry-After': str(api.retry_after)})
+            return
+
+        if method == 'GET' and path == '/v1/users/me':
+            api.count('notion.users_me')
+            self.send_json({'object': 'user', 'name': 'benchmark', 'type': 'bot'})
+        elif method == 'POST' and path == f'/v1/databases/{COMUNI_DB_ID}/query':
+            api.count('notion.query_comuni')
+            self.send_json(self.query_comuni(body))
+        elif method == 'POST' and path == f'/v1/databases/{CONTATTI_DB_ID}/query':
+            api.count('notion.query_contatti')
+            self.send_json({'results': [], 'has_more': False, 'next_cursor': None})
+        elif method == 'POST' and path == '/v1/pages':
+            api.count('notion.pages_create')
+            self.send_json({'object': 'page', 'id': str(uuid.uuid4())})
+        elif method == 'PATCH' and path.startswith('/v1/pages/'):
+            api.count('notion.pages_update')
+            self.send_json({'object': 'page', 'id': path.rsplit('/', 1)[-1]})
+        elif method == 'POST' and path == '/v1/chat/completions':
+            api.count('openai.chat')
+            self.send_json(self.chat_completion(body))
+        else:
+            api.count('not_found')
+            self.send_json({'object': 'error', 'message': f'{method} {path}'}, 404)
+
+    def query_comuni(self, body):
+        comuni = self.server.api.dataset.comuni
+        filtro = body.get('filter') or {}
+        title = filtro.get('title', {})
+        if 'or' in filtro:
+            nomi = {f['title']['equals'] for f in filtro['or']}
+            comuni = [c for c in comuni if c['nome'] in nomi]
+        elif 'equals' in title:
+            comuni = [c for c in comuni if c['nome'] == title['equals']]
+        elif 'contains' in title:
+            needle = title['contains'].lower()
+            comuni = [c for c in comuni if needle in c['nome'].lower()]
+
+        start = int(body.get('start_cursor') or 0)
+        size = min(int(body.get('page_size', 100)), 100)
+        page = comuni[start:start + size]
+        has_more = start + size < len(comuni)
+        return {
+            'results': [{'id': c['id'], 'properties': {'Name': {'title': [{'plain_text': c['nome']}]}}}
+                        for c in page],
+            'has_more': has_more,
+            'next_cursor': str(start + size) if has_more else None
+        }
+
+    def chat_completion(self, body):
+        typos = self.server.api.dataset.typos
+        prompt = body['messages'][-1]['content']
+        if 'Elenco:' in prompt:
+            elenco = json.loads(prompt.split('Elenco:', 1)[1])
+            risultati = [{'id': item['id'],
+                          'corretto': typos.get(item['nome'].lower(), 'NON_TROVATO')}
+                         for item in elenco]
+            content = json.dumps({'risultati': risultati}, ensure_ascii=False)
+        else:
+            nome = prompt.split('Nome da correggere:', 1)[-1].splitlines()[0].strip()
+            content = typos.get(nome.lower(), 'NON_TROVATO')
+        return {'choices': [{'message': {'role': 'assistant', 'content': content}}]}
+
+    def send_json(self, data, status=200, headers=None):
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeAPIServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, api):
+        super().__init__(address, FakeAPIHandler)
+        self.api = api
+
+
+# ===== ESECUZIONE =====
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def http_json(url, body=None, timeout=30):
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def peak_rss_mb(pid):
+    """Picco di memoria residente del processo (VmHWM su Linux)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # Fallback: massimo tra i processi figli terminati (KB su Linux, byte su macOS)
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_size(args, api, api_url, rows, workdir):
+    """Avvia server.py, importa un CSV di `rows` righe e ritorna le metriche"""
+    csv_bytes = api.dataset.generate_csv(rows)
+    port = free_port()
+    env = dict(os.environ,
+               NOTION_TOKEN='secret_benchmark',
+               CONTATTI_DB_ID=CONTATTI_DB_ID,
+               COMUNI_DB_ID=COMUNI_DB_ID,
+               OPENAI_API_KEY='sk-benchmark' if not args.no_openai else '',
+               NOTION_API_URL=api_url,
+               OPENAI_API_URL=api_url,
+               NOTION_RATE=str(args.notion_rate),
+               NOTION_BURST=str(max(1, int(args.notion_rate))),
+               IMPORT_WORKERS=str(args.workers),
+               API_BACKOFF_BASE='0.05',
+               RESOLUTION_CACHE_PATH=os.path.join(workdir, f'cache_{rows}.sqlite3'),
+               IMPORT_JOURNAL_DIR=os.path.join(workdir, f'journal_{rows}'),
+               PORT=str(port),
+               PYTHONUNBUFFERED='1')
+
+    log = open(args.server_log, 'a') if args.server_log else subprocess.DEVNULL
+    server = subprocess.Popen([sys.executable, 'server.py'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              env=env, stdout=log, stderr=subprocess.STDOUT)
+    base = f'http://127.0.0.1:{port}'
+    try:
+        # Il server risponde solo dopo il precaricamento dell'indice comuni
+        deadline = time.time() + 60
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError('server.py terminato durante l\'avvio')
+            try:
+                http_json(f'{base}/comuni/status', timeout=2)
+                break
+            except (urllib.error.URLError, ConnectionError):
+                if time.time() > deadline:
+                    raise RuntimeError('server.py non risponde')
+                time.sleep(0.2)
+
+        api.reset()
+        mapping = {'email': 'Email', 'nome': 'Nome', 'carica': 'Carica',
+                   'comune': 'Comune', 'telefono': 'Telefono', 'sito': 'Sito'}
+        start = time.perf_counter()
+        response = http_json(f'{base}/parse-and-import', {
+            'content': base64.b64encode(csv_bytes).decode('ascii'),
+            'mapping': mapping,
+            'resume': False
+        }, timeout=300)
+        if not response.get('success'):
+            raise RuntimeError(response.get('error'))
+
+        while True:
+            job = http_json(f"{base}/jobs/{response['job_id']}")['job']
+            if job['status'] in ('completed', 'failed'):
+                break
+            time.sleep(0.2)
+        elapsed = time.perf_counter() - start
+        rss = peak_rss_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+        if log is not subprocess.DEVNULL:
+            log.close()
+
+    if job['status'] != 'completed':
+        raise RuntimeError(f"importazione fallita: {job.get('error')}")
+
+    results = job['results']
+    calls = api.snapshot()
+    api_calls = sum(n for key, n in calls.items() if key != 'http_429')
+    latency = results.get('latenza_righe_ms') or {}
+    return {
+        'rows': rows,
+        'csv_bytes': len(csv_bytes),
+        'seconds': round(elapsed, 2),
+        'rows_per_sec': round(rows / elapsed, 1),
+        'row_latency_ms': {'p50': latency.get('p50'), 'p99': latency.get('p99')},
+        'calls': calls,
+        'calls_per_row': round(api_calls / rows, 3),
+        'http_429': calls.get('http_429', 0),
+        'retries': results.get('retry', {}).get('retries', 0),
+        'success': results.get('success', 0),
+        'errors': len(results.get('errors', [])),
+        'comuni_non_trovati': len(results.get('comuni_non_trovati', [])),
+        'peak_rss_mb': rss
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark offline dell\'importazione CSV')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='righe dei CSV generati, separate da virgola')
+    parser.add_argument('--latency-ms', type=float, default=20, help='latenza media del finto server')
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help='probabilità di rispondere 429 a una chiamata (0-1)')
+    parser.add_argument('--retry-after', type=float, default=0.1, help='Retry-After dei 429 (secondi)')
+    parser.add_argument('--comuni', type=int, default=8000, help='comuni nel database fittizio')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workers', type=int, default=4, help='IMPORT_WORKERS del server')
+    parser.add_argument('--notion-rate', type=float, default=1000,
+                        help='NOTION_RATE del server (default alto: misura il server, non il limite)')
+    parser.add_argument('--no-openai', action='store_true', help='disattiva la correzione OpenAI')
+    parser.add_argument('--server-log', help='file in cui salvare l\'output di server.py')
+    parser.add_argument('--output', help='file JSON dei risultati (default: stdout)')
+    args = parser.parse_args()
+
+    dataset = BenchDataset(args.seed, args.comuni)
+    api = FakeAPI(dataset, args.latency_ms, args.rate_limit, args.retry_after)
+    fake = FakeAPIServer(('127.0.0.1', 0), api)
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+    api_url = f'http://127.0.0.1:{fake.server_address[1]}/v1'
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'server_log')},
+        'runs': []
+    }
+
+    with tempfile.TemporaryDirectory(prefix='bench_') as workdir:
+        for size in (int(s) for s in args.sizes.split(',') if s.strip()):
+            print(f'[BENCH] {size} righe...', file=sys.stderr)
+            run = run_size(args, api, api_url, size, workdir)
+            print(f"[BENCH] {size} righe: {run['rows_per_sec']} righe/s, "
+                  f"p99 {run['row_latency_ms']['p99']} ms, {run['calls_per_row']} chiamate/riga, "
+                  f"RSS {run['peak_rss_mb']} MB", file=sys.stderr)
+            report['runs'].append(run)
+
+    fake.shutdown()
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,19 +4,33 @@ Server per importazione CSV in Notion - VERSIONE FINALE CORRETTA
 Gestisce upload, parsing, mapping, correzione comuni e import massivo
 """
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import json
-import urllib.request
 import urllib.parse
+import http.client
 import csv
 import io
 import base64
 import time
 import re
+import heapq
+import random
+from concurrent.futures import ThreadPoolExecutor
 from difflib import SequenceMatcher
 import traceback
 from datetime import datetime
 import os
+import sys
+import argparse
+import threading
+import unicodedata
+import codecs
+import tempfile
+from collections import deque
+import uuid
+import sqlite3
+import hashlib
+from contextlib import contextmanager, nullcontext
 
 # Prova a caricare le variabili dal file .env se esiste
 try:
@@ -30,7 +44,8 @@ except ImportError:
                 line = line.strip()
                 if line and not line.startswith('#') and '=' in line:
                     key, value = line.split('=', 1)
-                    os.environ[key.strip()] = value.strip()
+                    # Come load_dotenv: le variabili già impostate hanno la precedenza
+                    os.environ.setdefault(key.strip(), value.strip())
 
 # Configurazione - Leggi da variabili di ambiente
 NOTION_TOKEN = os.environ.get("NOTION_TOKEN")
@@ -40,11 +55,2810 @@ COMUNI_DB_ID = os.environ.get("COMUNI_DB_ID")
 # OpenAI API Key - opzionale
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
-# Cache per i comuni
-COMUNI_CACHE = {}
+# Endpoint delle API (sovrascrivibili per puntare a un server di test, es. benchmark.py)
+NOTION_API_URL = os.environ.get("NOTION_API_URL", "https://api.notion.com/v1").rstrip('/')
+OPENAI_API_URL = os.environ.get("OPENAI_API_URL", "https://api.openai.com/v1").rstrip('/')
+
+# Import concorrente: numero di worker e limite richieste Notion (req/s e burst)
+IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", "4"))
+NOTION_RATE = float(os.environ.get("NOTION_RATE", "3"))
+NOTION_BURST = int(os.environ.get("NOTION_BURST", "3"))
+
+# Connessioni HTTP persistenti mantenute per host
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", str(IMPORT_WORKERS + 2)))
+
+# Retry delle chiamate API: tentativi massimi e backoff esponenziale (secondi)
+API_MAX_RETRIES = int(os.environ.get("API_MAX_RETRIES", "5"))
+API_BACKOFF_BASE = float(os.environ.get("API_BACKOFF_BASE", "0.5"))
+API_BACKOFF_MAX = float(os.environ.get("API_BACKOFF_MAX", "30"))
+
+# Cache persistente delle risoluzioni dei comuni (SQLite)
+RESOLUTION_CACHE_PATH = os.environ.get("RESOLUTION_CACHE_PATH", "comuni_cache.sqlite3")
+RESOLUTION_CACHE_TTL = float(os.environ.get("RESOLUTION_CACHE_TTL_DAYS", "90")) * 86400
+RESOLUTION_CACHE_NEGATIVE_TTL = float(os.environ.get("RESOLUTION_CACHE_NEGATIVE_TTL_HOURS", "24")) * 3600
+RESOLUTION_CACHE_MAX_ENTRIES = int(os.environ.get("RESOLUTION_CACHE_MAX_ENTRIES", "100000"))
+
+# Indice delle email già presenti in Contatti: validità prima di ricaricarlo (secondi)
+CONTATTI_INDEX_TTL = float(os.environ.get("CONTATTI_INDEX_TTL", "600"))
+
+# Journal delle importazioni (ripresa dopo un'interruzione)
+IMPORT_JOURNAL_DIR = os.environ.get("IMPORT_JOURNAL_DIR", "import_journal")
+IMPORT_JOURNAL_SYNC_EVERY = int(os.environ.get("IMPORT_JOURNAL_SYNC_EVERY", "20"))
+
+# Tracing per riga (opzionale): cartella dei file JSONL e righe più lente nel riepilogo
+IMPORT_TRACE_DIR = os.environ.get("IMPORT_TRACE_DIR", "import_traces")
+IMPORT_TRACE_TOP_N = int(os.environ.get("IMPORT_TRACE_TOP_N", "20"))
+# File di traccia conservati: oltre questo numero vengono eliminati i più vecchi
+IMPORT_TRACE_MAX_FILES = max(1, int(os.environ.get("IMPORT_TRACE_MAX_FILES", "50")))
+
+# Nomi di comuni inviati a OpenAI in una singola richiesta di correzione
+OPENAI_BATCH_SIZE = int(os.environ.get("OPENAI_BATCH_SIZE", "50"))
+
+# Soglia di confidenza per accettare un match fuzzy locale (0-1)
+FUZZY_THRESHOLD = float(os.environ.get("FUZZY_THRESHOLD", "0.85"))
+
+# Nomi cercati in una sola query Notion (filtro `or` di condizioni `title equals`;
+# Notion accetta al massimo 100 elementi per array nel corpo della richiesta)
+NOTION_FILTER_BATCH = max(1, min(100, int(os.environ.get("NOTION_FILTER_BATCH", "100"))))
+
+# Risoluzioni concordi (nomi diversi, stesso comune) per associare un dominio email a un comune
+DOMINI_MIN_RISOLUZIONI = int(os.environ.get("DOMINI_MIN_RISOLUZIONI", "2"))
+
+
+class TokenBucket:
+    """Rate limiter a token bucket condiviso tra thread.
+
+    `rate` token al secondo, fino a `burst` accumulabili. `acquire()` blocca
+    finché non è disponibile un token.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = rate / 10
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self):
+        """Dimezza il rate dopo un 429 (non sotto il 10% del rate configurato)"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+            return self.rate
+
+    def recover(self):
+        """Dopo una risposta riuscita riporta gradualmente il rate al valore configurato"""
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+# Limite condiviso per tutte le chiamate verso api.notion.com
+NOTION_RATE_LIMITER = TokenBucket(NOTION_RATE, NOTION_BURST)
+
+
+class APIError(Exception):
+    """Errore definitivo di una chiamata API (dopo eventuali retry).
+
+    `incerto` indica una richiesta non idempotente dall'esito sconosciuto
+    (timeout, 5xx, connessione interrotta): è il chiamante a decidere se
+    ritentarla e a conteggiare l'errore nei RetryStats.
+    """
+
+    def __init__(self, message, status=None, body='', incerto=False):
+        super().__init__(message)
+        self.status = status
+        self.body = body
+        self.incerto = incerto
+
+
+class RetryStats:
+    """Contatori thread-safe dei retry effettuati durante un'importazione"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {
+                'retries': 0,
+                'rate_limited': 0,
+                'server_errors': 0,
+                'timeouts': 0,
+                'failed': 0
+            }
+
+    def incr(self, key):
+        with self._lock:
+            self.counters[key] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+class Metrics:
+    """Registro di metriche in formato Prometheus (contatori, gauge, istogrammi).
+
+    Le serie sono identificate da nome ed etichette; `render()` produce il
+    testo esposto da GET /metrics.
+    """
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._values = {}
+        self._histograms = {}
+
+    def describe(self, name, kind, help_text, buckets=None):
+        """Registra tipo ('counter', 'gauge' o 'histogram') e descrizione di una metrica"""
+        self._meta[name] = (kind, help_text, tuple(buckets or self.DEFAULT_BUCKETS))
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        """Incrementa un contatore o una gauge (value negativo per decrementare)"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, labels=None):
+        """Aggiunge un'osservazione (in secondi) a un istogramma"""
+        buckets = self._meta[name][2]
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        """Misura la durata del blocco nell'istogramma `name`"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, labels)
+
+    @contextmanager
+    def in_flight(self, name, labels=None):
+        """Gauge delle operazioni in corso durante il blocco"""
+        self.inc(name, labels)
+        try:
+            yield
+        finally:
+            self.inc(name, labels, -1)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        parts = []
+        for key, value in items:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{key}="{value}"')
+        return '{' + ','.join(parts) + '}'
+
+    def render(self):
+        """Testo in formato di esposizione Prometheus (text/plain 0.0.4)"""
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self._histograms.items()}
+
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(self._meta.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'histogram':
+                for (series, labels), (counts, total, count) in sorted(histograms.items()):
+                    if series != name:
+                        continue
+                    cumulative = 0
+                    for bound, n in zip(buckets, counts):
+                        cumulative += n
+                        lines.append(f'{name}_bucket{self._format_labels(labels, [("le", bound)])} {cumulative}')
+                    lines.append(f'{name}_bucket{self._format_labels(labels, [("le", "+Inf")])} {count}')
+                    lines.append(f'{name}_sum{self._format_labels(labels)} {total:.6f}')
+                    lines.append(f'{name}_count{self._format_labels(labels)} {count}')
+            else:
+                for (series, labels), value in sorted(values.items()):
+                    if series == name:
+                        lines.append(f'{name}{self._format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# Metriche esposte da GET /metrics
+METRICS = Metrics()
+METRICS.describe('csv_import_stage_seconds', 'histogram',
+                 "Durata delle fasi dell'importazione (parse CSV, query comuni, OpenAI, creazione pagine)")
+METRICS.describe('csv_import_api_request_seconds', 'histogram',
+                 'Durata di ogni chiamata HTTP verso Notion/OpenAI (singolo tentativo)')
+METRICS.describe('csv_import_api_responses_total', 'counter',
+                 'Risposte di Notion/OpenAI per codice HTTP (error = errore di rete)')
+METRICS.describe('csv_import_api_in_flight', 'gauge', 'Chiamate verso Notion/OpenAI in corso')
+METRICS.describe('csv_import_http_requests_in_flight', 'gauge', 'Richieste in corso su questo server')
+METRICS.describe('csv_import_comune_cache_total', 'counter',
+                 'Ricerche nella cache comuni (cache=import|persistent, result=hit|miss)')
+METRICS.describe('csv_import_rows_total', 'counter', 'Righe elaborate per esito')
+METRICS.describe('csv_import_jobs_running', 'gauge', 'Importazioni in corso')
+METRICS.describe('csv_import_jobs_total', 'counter', 'Importazioni terminate per stato')
+METRICS.describe('csv_import_comuni_index_entries', 'gauge', "Comuni nell'indice in memoria")
+METRICS.describe('csv_import_contatti_index_entries', 'gauge', "Email nell'indice dei contatti")
+METRICS.describe('csv_import_domini_index_entries', 'gauge', "Domini email associati a un comune")
+
+
+class RowTrace:
+    """Albero di span di una singola riga (fasi, stato HTTP, esito della cache).
+
+    Ogni span è un dict con `name`, `start`/`end` (epoch in secondi),
+    eventuali attributi e gli span figli in `children`.
+    """
+
+    def __init__(self, row_num, name='row'):
+        self.row = row_num
+        self.root = {'name': name, 'start': time.time(), 'end': None, 'children': []}
+        self._stack = [self.root]
+
+    @contextmanager
+    def span(self, name, **attrs):
+        span = {'name': name, 'start': time.time(), 'end': None, **attrs, 'children': []}
+        self._stack[-1]['children'].append(span)
+        self._stack.append(span)
+        try:
+            yield span
+        finally:
+            span['end'] = time.time()
+            self._stack.pop()
+
+    def annotate(self, **attrs):
+        """Aggiunge attributi allo span corrente"""
+        self._stack[-1].update(attrs)
+
+    def finish(self, result):
+        self.root['end'] = time.time()
+        if result.get('skipped'):
+            self.root['esito'] = 'saltato'
+        elif result.get('updated'):
+            self.root['esito'] = 'aggiornato'
+        else:
+            self.root['esito'] = 'creato' if result.get('success') else 'errore'
+        if result.get('error'):
+            self.root['error'] = result['error']
+
+    @property
+    def duration(self):
+        return (self.root['end'] or time.time()) - self.root['start']
+
+    def dominant_stage(self):
+        """Fase con il maggior tempo proprio (escluso quello dei figli): (nome, secondi)"""
+        totals = {}
+
+        def visit(span):
+            children = span['children']
+            own = (span['end'] - span['start']) - sum(c['end'] - c['start'] for c in children)
+            totals[span['name']] = totals.get(span['name'], 0) + max(0.0, own)
+            for child in children:
+                visit(child)
+
+        visit(self.root)
+        return max(totals.items(), key=lambda item: item[1])
+
+
+# Traccia della riga elaborata dal thread corrente (None se il tracing è spento)
+_TRACE_LOCAL = threading.local()
+
+
+def current_trace():
+    return getattr(_TRACE_LOCAL, 'trace', None)
+
+
+def trace_span(name, **attrs):
+    """Span nella traccia della riga corrente; senza tracing non fa nulla (yield None)"""
+    trace = current_trace()
+    return trace.span(name, **attrs) if trace else nullcontext()
+
+
+@contextmanager
+def trace_stage(stage, **attrs):
+    """Fase dell'importazione: istogramma in /metrics e span nella traccia della riga"""
+    with METRICS.timer('csv_import_stage_seconds', {'stage': stage}), \
+            trace_span(stage, **attrs) as span:
+        yield span
+
+
+def trace_annotate(**attrs):
+    """Attributi sullo span corrente della riga (se il tracing è attivo)"""
+    trace = current_trace()
+    if trace:
+        trace.annotate(**attrs)
+
+
+class JobTracer:
+    """Scrive le tracce delle righe di un job in IMPORT_TRACE_DIR/<job_id>.jsonl
+    e tiene le IMPORT_TRACE_TOP_N righe più lente per il riepilogo.
+
+    Anche la fase dei comuni, che precede le righe, finisce nello stesso file:
+    una traccia per la correzione in blocco e una per ogni coppia risolta.
+    """
+
+    def __init__(self, job_id, directory=None, top_n=None):
+        self.job_id = job_id
+        directory = directory or IMPORT_TRACE_DIR
+        os.makedirs(directory, exist_ok=True)
+        self.prune(directory, IMPORT_TRACE_MAX_FILES - 1)
+        self.path = os.path.join(directory, f'{job_id}.jsonl')
+        self.top_n = top_n or IMPORT_TRACE_TOP_N
+        self._lock = threading.Lock()
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._slowest = []
+        self._slowest_comuni = []
+        self.rows = 0
+        self.comuni = 0
+
+    @staticmethod
+    def prune(directory, keep):
+        """Elimina i file di traccia più vecchi lasciandone al massimo `keep`"""
+        try:
+            paths = [os.path.join(directory, name) for name in os.listdir(directory)
+                     if name.endswith('.jsonl')]
+            paths.sort(key=os.path.getmtime, reverse=True)
+        except OSError as e:
+            print(f"[TRACE] Errore pulizia tracce: {e}")
+            return
+        for path in paths[keep:]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"[TRACE] Errore eliminazione {path}: {e}")
+    
+    def begin_row(self, row_num):
+        trace = RowTrace(row_num)
+        _TRACE_LOCAL.trace = trace
+        return trace
+
+    def end_row(self, trace, result):
+        _TRACE_LOCAL.trace = None
+        trace.finish(result)
+        stage, stage_seconds = trace.dominant_stage()
+        line = json.dumps({'row': trace.row, **trace.root}, ensure_ascii=False)
+        summary = {
+            'row': trace.row,
+            'ms': round(trace.duration * 1000, 1),
+            'fase_dominante': stage,
+            'fase_ms': round(stage_seconds * 1000, 1),
+            'esito': trace.root['esito']
+        }
+        with self._lock:
+            self._file.write(line + '\n')
+            self.rows += 1
+            self._keep_slowest(self._slowest, (trace.duration, trace.row, summary))
+    
+    def begin_comune(self, name, **attrs):
+        """Traccia della fase dei comuni (blocco o coppia nome/dominio) sul thread corrente"""
+        trace = RowTrace(None, name)
+        trace.root.update(attrs)
+        _TRACE_LOCAL.trace = trace
+        return trace
+    
+    def end_comune(self, trace, esito):
+        _TRACE_LOCAL.trace = None
+        trace.root['end'] = time.time()
+        trace.root['esito'] = esito
+        stage, stage_seconds = trace.dominant_stage()
+        line = json.dumps({'fase': 'comuni', **trace.root}, ensure_ascii=False)
+        summary = {
+            'traccia': trace.root['name'],
+            'ms': round(trace.duration * 1000, 1),
+            'fase_dominante': stage,
+            'fase_ms': round(stage_seconds * 1000, 1),
+            'esito': esito
+        }
+        for key in ('comune', 'dominio'):
+            if key in trace.root:
+                summary[key] = trace.root[key]
+        with self._lock:
+            self._file.write(line + '\n')
+            self.comuni += 1
+            self._keep_slowest(self._slowest_comuni, (trace.duration, self.comuni, summary))
+    
+    def _keep_slowest(self, heap, entry):
+        if len(heap) < self.top_n:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    def close(self):
+        """Chiude il file e ritorna il riepilogo (righe più lente prima)"""
+        with self._lock:
+            self._file.close()
+            slowest = [summary for _, _, summary in sorted(self._slowest, reverse=True)]
+            slowest_comuni = [summary for _, _, summary in sorted(self._slowest_comuni, reverse=True)]
+        return {
+            'job_id': self.job_id,
+            'righe': self.rows,
+            'comuni': self.comuni,
+            'download': f'/jobs/{self.job_id}/trace',
+            'righe_lente': slowest,
+            'comuni_lenti': slowest_comuni
+        }
+
+
+# Codici HTTP per cui ha senso ritentare
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class RequestNotSentError(ConnectionError):
+    """Connessione non stabilita: la richiesta non è arrivata al server"""
+
+
+class HTTPConnectionPool:
+    """Pool di connessioni HTTP(S) persistenti (keep-alive) per host.
+
+    Evita un nuovo handshake TCP/TLS per ogni chiamata: le connessioni libere
+    vengono riutilizzate e, se il socket risulta chiuso dal server, la richiesta
+    viene ripetuta una volta su una connessione nuova.
+    """
+
+    def __init__(self, max_per_host=8):
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._stats = {'created': 0, 'reused': 0, 'reconnects': 0, 'discarded': 0, 'requests': 0}
+
+    def _get(self, key, timeout):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                conn = idle.pop()
+                self._stats['reused'] += 1
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        return self._connect(key, timeout), False
+
+    def _connect(self, key, timeout):
+        scheme, host, port = key
+        with self._lock:
+            self._stats['created'] += 1
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=timeout)
+        return http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_per_host:
+                idle.append(conn)
+                return
+            self._stats['discarded'] += 1
+        conn.close()
+
+    def request(self, method, url, headers, data=None, timeout=10, idempotent=True):
+        """Esegue la richiesta e ritorna (status, headers, body).
+
+        Con `idempotent=False` una connessione riutilizzata chiusa dal server
+        non viene ritentata (la richiesta potrebbe essere già stata elaborata);
+        un errore di connessione prima dell'invio solleva RequestNotSentError.
+        """
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme or 'https'
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parsed.hostname, port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        with self._lock:
+            self._stats['requests'] += 1
+
+        conn, reused = self._get(key, timeout)
+        if not reused:
+            try:
+                conn.connect()
+            except OSError as e:
+                conn.close()
+                raise RequestNotSentError(str(e)) from e
+        try:
+            conn.request(method, path, body=data, headers=headers)
+            response = conn.getresponse()
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            conn.close()
+            if not reused or not idempotent:
+                raise
+            # Il server ha chiuso la connessione inattiva: riprova su una nuova
+            with self._lock:
+                self._stats['reconnects'] += 1
+            conn = self._connect(key, timeout)
+            try:
+                try:
+                    conn.connect()
+                except OSError as e:
+                    raise RequestNotSentError(str(e)) from e
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        try:
+            body = response.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(key, conn)
+        return response.status, response.headers, body
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = {f'{k[0]}://{k[1]}:{k[2]}': len(v) for k, v in self._idle.items()}
+        stats['max_per_host'] = self.max_per_host
+        return stats
+
+
+# Pool condiviso per api.notion.com e api.openai.com
+HTTP_POOL = HTTPConnectionPool(HTTP_POOL_SIZE)
+
+
+def _send_request(method, url, headers, data, timeout, idempotent=True):
+    """Esegue una singola richiesta HTTP e ritorna (status, headers, body)"""
+    return HTTP_POOL.request(method, url, headers, data, timeout, idempotent)
+
+
+def _retry_delay(attempt, retry_after=None):
+    """Attesa prima del prossimo tentativo: Retry-After se presente,
+    altrimenti backoff esponenziale con jitter"""
+    if retry_after:
+        try:
+            return min(API_BACKOFF_MAX, float(retry_after)) + random.uniform(0, 0.5)
+        except ValueError:
+            pass
+    delay = min(API_BACKOFF_MAX, API_BACKOFF_BASE * (2 ** attempt))
+    return random.uniform(delay / 2, delay)
+
+
+def api_request(method, url, headers, body=None, timeout=10, limiter=None, label='API', stats=None,
+                idempotent=True):
+    """Chiamata HTTP JSON con retry su 429/5xx/timeout.
+
+    Rispetta `Retry-After`, usa backoff esponenziale con jitter e, se viene
+    passato un `limiter`, ne abbassa il rate finché persiste il throttling.
+    Con `idempotent=False` (es. creazione di pagine) ritenta solo i 429 e gli
+    errori di connessione prima dell'invio: timeout, 5xx e connessioni
+    interrotte hanno esito incerto e sollevano subito `APIError(incerto=True)`,
+    senza conteggiarlo (lo fa il chiamante, che può ritentare).
+    I retry vengono conteggiati in `stats` (RetryStats dell'importazione).
+    Ritorna il JSON decodificato o solleva `APIError`.
+    """
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    count = stats.incr if stats else (lambda key: None)
+    api = {'api': label.lower()}
+
+    for attempt in range(API_MAX_RETRIES + 1):
+        if limiter:
+            with trace_span('rate_limit_wait'):
+                limiter.acquire()
+
+        retry_after = None
+        span = None
+        try:
+            with METRICS.in_flight('csv_import_api_in_flight', api), \
+                    METRICS.timer('csv_import_api_request_seconds', api), \
+                    trace_span('http', api=api['api'], method=method, attempt=attempt) as span:
+                status, resp_headers, raw = _send_request(method, url, headers, data, timeout, idempotent)
+        except (OSError, http.client.HTTPException) as e:
+            METRICS.inc('csv_import_api_responses_total', dict(api, status='error'))
+            if span is not None:
+                span['status'] = 'error'
+            if not (idempotent or isinstance(e, RequestNotSentError)):
+                raise APIError(f"{label}: {e}", incerto=True) from e
+            if attempt >= API_MAX_RETRIES:
+                count('failed')
+                raise APIError(f"{label}: {e}") from e
+            count('timeouts')
+            reason = f"errore di rete ({e})"
+        else:
+            METRICS.inc('csv_import_api_responses_total', dict(api, status=str(status)))
+            if span is not None:
+                span['status'] = status
+            if 200 <= status < 300:
+                if limiter:
+                    limiter.recover()
+                return json.loads(raw.decode('utf-8')) if raw else {}
+
+            error_body = raw.decode('utf-8', errors='replace') if raw else ''
+            if not idempotent and status >= 500 and status in RETRYABLE_STATUS:
+                raise APIError(f"{label}: HTTP {status}", status=status, body=error_body, incerto=True)
+            if status not in RETRYABLE_STATUS or attempt >= API_MAX_RETRIES:
+                count('failed')
+                raise APIError(f"{label}: HTTP {status}", status=status, body=error_body)
+
+            if status == 429:
+                count('rate_limited')
+                retry_after = resp_headers.get('Retry-After') if resp_headers else None
+                if limiter:
+                    new_rate = limiter.throttle()
+                    print(f"[RETRY] {label}: rate limit, rate ridotto a {new_rate:.2f}/s")
+            else:
+                count('server_errors')
+            reason = f"HTTP {status}"
+
+        count('retries')
+        delay = _retry_delay(attempt, retry_after)
+        print(f"[RETRY] {label}: {reason}, nuovo tentativo {attempt + 1}/{API_MAX_RETRIES} tra {delay:.1f}s")
+        time.sleep(delay)
+
+
+def notion_request(method, path, body=None, timeout=10, stats=None, idempotent=True):
+    """Chiamata all'API Notion attraverso il rate limiter condiviso"""
+    headers = {
+        'Authorization': f'Bearer {NOTION_TOKEN}',
+        'Notion-Version': '2022-06-28',
+        'Content-Type': 'application/json'
+    }
+    return api_request(
+        method,
+        f'{NOTION_API_URL}/{path}',
+        headers,
+        body=body,
+        timeout=timeout,
+        limiter=NOTION_RATE_LIMITER,
+        label='Notion',
+        stats=stats,
+        idempotent=idempotent
+    )
+
+
+def openai_request(body, timeout=10, stats=None):
+    """Chiamata a OpenAI chat completions con retry"""
+    headers = {
+        'Authorization': f'Bearer {OPENAI_API_KEY}',
+        'Content-Type': 'application/json'
+    }
+    with trace_stage('openai'):
+        return api_request(
+            'POST',
+            f'{OPENAI_API_URL}/chat/completions',
+            headers,
+            body=body,
+            timeout=timeout,
+            label='OpenAI',
+            stats=stats
+        )
+
+
+def normalizza_nome_comune(nome):
+    """Normalizza un nome di comune per il confronto: minuscolo, senza accenti,
+    apostrofi/punteggiatura trasformati in spazi e spazi compattati.
+    Es. "Barzano'" e "Barzanò" diventano entrambi "barzano"."""
+    if not nome:
+        return ''
+    testo = unicodedata.normalize('NFKD', nome.casefold())
+    testo = ''.join(c for c in testo if not unicodedata.combining(c))
+    testo = re.sub(r'\([^)]*\)', ' ', testo)  # sigla provincia, es. "(VT)"
+    testo = re.sub(r"[\'’`´.\-_/]", ' ', testo)
+    return ' '.join(testo.split())
+
+
+def trigrammi(testo):
+    """Insieme dei trigrammi di caratteri di un nome già normalizzato"""
+    padded = f'  {testo} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ComuniIndex:
+    """Indice in memoria dell'intero database Comuni (nome normalizzato → pagina).
+
+    Viene popolato una sola volta paginando `databases/{COMUNI_DB_ID}/query`,
+    così durante l'importazione le ricerche dei comuni non fanno chiamate di rete.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._by_name = {}
+        self._trigram_index = {}
+        self._gram_counts = {}
+        self._ids = set()
+        self.loaded = False
+        self.loaded_at = None
+        self.total_pages = 0
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def lookup(self, nome):
+        """Ritorna {'id', 'nome'} se il nome normalizzato è nell'indice"""
+        chiave = normalizza_nome_comune(nome)
+        if not chiave:
+            return None
+        return self._by_name.get(chiave)
+
+    def fuzzy_lookup(self, nome, limit=5):
+        """Ricerca approssimata locale tramite indice invertito di trigrammi.
+
+        Ritorna una lista di candidati {'id', 'nome', 'score'} ordinata per
+        score decrescente (similarità SequenceMatcher sui nomi normalizzati).
+        """
+        chiave = normalizza_nome_comune(nome)
+        if not chiave:
+            return []
+
+        query_grams = trigrammi(chiave)
+        by_name = self._by_name
+        trigram_index = self._trigram_index
+
+        # Conta i trigrammi in comune per ogni nome candidato
+        shared = {}
+        for gram in query_grams:
+            for candidate in trigram_index.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+
+        if not shared:
+            return []
+
+        # Preselezione per coefficiente di Dice, poi scoring più preciso
+        gram_counts = self._gram_counts
+        n_query = len(query_grams)
+        prefiltered = heapq.nlargest(
+            30,
+            shared.items(),
+            key=lambda item: item[1] / (n_query + gram_counts[item[0]])
+        )
+
+        candidates = []
+        for candidate, _ in prefiltered:
+            score = SequenceMatcher(None, chiave, candidate).ratio()
+            entry = by_name[candidate]
+            candidates.append({'id': entry['id'], 'nome': entry['nome'], 'score': round(score, 3)})
+
+        candidates.sort(key=lambda c: c['score'], reverse=True)
+        return candidates[:limit]
+
+    def best_match(self, nome, threshold=None):
+        """Miglior candidato fuzzy se supera la soglia, altrimenti None"""
+        if threshold is None:
+            threshold = FUZZY_THRESHOLD
+        candidates = self.fuzzy_lookup(nome, limit=2)
+        if not candidates or candidates[0]['score'] < threshold:
+            return None
+        # Due candidati equivalenti: meglio lasciar decidere l'AI
+        if len(candidates) > 1 and candidates[1]['score'] == candidates[0]['score']:
+            return None
+        return candidates[0]
+
+    def has_id(self, comune_id):
+        """True se la pagina comune è presente nell'indice"""
+        return comune_id in self._ids
+
+    def entries(self):
+        """Pagine presenti nell'indice ({'id', 'nome'})"""
+        return list(self._by_name.values())
+
+    def names(self):
+        """Elenco dei nomi canonici presenti nell'indice"""
+        return [entry['nome'] for entry in self._by_name.values()]
+
+    def load(self):
+        """Scarica tutte le pagine del database Comuni e ricostruisce l'indice"""
+        if not COMUNI_DB_ID:
+            raise ValueError("COMUNI_DB_ID non configurato")
+
+        start = time.time()
+        by_name = {}
+        total = 0
+        duplicates = 0
+        cursor = None
+
+        while True:
+            body = {'page_size': 100}
+            if cursor:
+                body['start_cursor'] = cursor
+
+            data = notion_request('POST', f'databases/{COMUNI_DB_ID}/query', body, timeout=30)
+
+            for result in data.get('results', []):
+                title = result.get('properties', {}).get('Name', {}).get('title', [])
+                if not title:
+                    continue
+                comune_nome = ''.join(t.get('plain_text', '') for t in title).strip()
+                chiave = normalizza_nome_comune(comune_nome)
+                if not chiave:
+                    continue
+                total += 1
+                if chiave in by_name:
+                    # Omonimi: si tiene la prima pagina trovata
+                    duplicates += 1
+                    continue
+                by_name[chiave] = {'id': result['id'], 'nome': comune_nome}
+
+            if not data.get('has_more'):
+                break
+            cursor = data.get('next_cursor')
+
+        trigram_index = {}
+        gram_counts = {}
+        for chiave in by_name:
+            grams = trigrammi(chiave)
+            gram_counts[chiave] = len(grams)
+            for gram in grams:
+                trigram_index.setdefault(gram, []).append(chiave)
+
+        with self._lock:
+            self._by_name = by_name
+            self._trigram_index = trigram_index
+            self._gram_counts = gram_counts
+            self._ids = {entry['id'] for entry in by_name.values()}
+            self.total_pages = total
+            self.duplicates = duplicates
+            self.loaded = True
+            self.loaded_at = datetime.now().isoformat(timespec='seconds')
+
+        print(f"[INDEX] Comuni caricati: {len(by_name)} ({total} pagine, "
+              f"{duplicates} omonimi) in {time.time() - start:.1f}s")
+        return self.stats()
+
+    def ensure_loaded(self):
+        """Carica l'indice se non è ancora stato popolato"""
+        if self.loaded:
+            return True
+        # Import concorrenti: uno solo scarica i comuni, gli altri attendono
+        with self._load_lock:
+            if self.loaded:
+                return True
+            try:
+                self.load()
+                return True
+            except Exception as e:
+                print(f"[INDEX] Impossibile caricare i comuni: {e}")
+                return False
+
+    def stats(self):
+        return {
+            'loaded': self.loaded,
+            'loaded_at': self.loaded_at,
+            'comuni': len(self._by_name),
+            'pagine': self.total_pages,
+            'omonimi': self.duplicates
+        }
+
+
+# Indice comuni condiviso (caricato all'avvio o su richiesta)
+COMUNI_INDEX = ComuniIndex()
+
+
+def find_comuni_on_notion(nomi, stats=None):
+    """Ricerca esatta di molti nomi sul database Comuni con poche query.
+
+    I nomi vengono raggruppati a blocchi di NOTION_FILTER_BATCH in un filtro
+    `or` di condizioni `title equals`; i risultati di ogni blocco vengono
+    paginati e ricondotti al nome richiesto (uguale, poi uguale una volta
+    normalizzato). Con più pagine per lo stesso nome vale la prima, come
+    nell'indice. Ritorna {nome richiesto: {'id', 'nome'}} per i nomi trovati.
+    """
+    distinti = list(dict.fromkeys(n for n in nomi if n))
+    found = {}
+    for start in range(0, len(distinti), NOTION_FILTER_BATCH):
+        blocco = distinti[start:start + NOTION_FILTER_BATCH]
+        esatti = {nome: nome for nome in blocco}
+        normalizzati = {}
+        for nome in blocco:
+            normalizzati.setdefault(normalizza_nome_comune(nome), nome)
+        
+        filtro = [{'property': 'Name', 'title': {'equals': nome}} for nome in blocco]
+        body = {'filter': filtro[0] if len(filtro) == 1 else {'or': filtro}, 'page_size': 100}
+        while True:
+            with trace_stage('notion_comune_query'):
+                data = notion_request('POST', f'databases/{COMUNI_DB_ID}/query', body, stats=stats)
+            for result in data.get('results', []):
+                title = result.get('properties', {}).get('Name', {}).get('title', [])
+                comune_nome = ''.join(t.get('plain_text', '') for t in title).strip()
+                richiesto = esatti.get(comune_nome) or normalizzati.get(normalizza_nome_comune(comune_nome))
+                if richiesto is None and len(blocco) == 1:
+                    richiesto = blocco[0]
+                if richiesto and richiesto not in found:
+                    found[richiesto] = {'id': result['id'], 'nome': comune_nome}
+            if not data.get('has_more'):
+                break
+            body['start_cursor'] = data.get('next_cursor')
+    return found
+
+
+def find_contatto_by_email(email, stats=None):
+    """Pagina di Contatti con quella `Email primaria` (None se assente)"""
+    body = {
+        'filter': {'property': 'Email primaria', 'title': {'equals': email}},
+        'page_size': 1
+    }
+    data = notion_request('POST', f'databases/{CONTATTI_DB_ID}/query', body, stats=stats)
+    results = data.get('results', [])
+    return results[0] if results else None
+
+
+def email_domain(email):
+    """Dominio di un indirizzo email in minuscolo ('' se assente)"""
+    if not email or '@' not in email:
+        return ''
+    return email.rsplit('@', 1)[1].strip().lower()
+
+
+class ResolutionStore:
+    """Cache persistente su SQLite: (nome comune, dominio email) → pagina comune.
+
+    Sopravvive ai riavvii ed è condivisa tra le importazioni. Anche i nomi non
+    trovati vengono memorizzati, ma con una scadenza più breve.
+    """
+
+    def __init__(self, path, ttl, negative_ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writes = 0
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS risoluzioni (
+                    nome TEXT NOT NULL,
+                    dominio TEXT NOT NULL,
+                    comune_id TEXT,
+                    comune_nome TEXT,
+                    creato REAL NOT NULL,
+                    PRIMARY KEY (nome, dominio)
+                )
+            ''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_creato ON risoluzioni (creato)')
+            self._conn.commit()
+        return self._conn
+
+    def get(self, nome, dominio=''):
+        """Ritorna (trovato, risultato): risultato è None per i negativi in cache"""
+        with self._lock:
+            row = self._db().execute(
+                'SELECT comune_id, comune_nome, creato FROM risoluzioni WHERE nome = ? AND dominio = ?',
+                (nome, dominio)
+            ).fetchone()
+        if not row:
+            return False, None
+
+        comune_id, comune_nome, creato = row
+        ttl = self.ttl if comune_id else self.negative_ttl
+        if time.time() - creato > ttl:
+            return False, None
+        if not comune_id:
+            return True, None
+        # Pagina non più presente nell'indice (comune rimosso/unito): la si ignora
+        if COMUNI_INDEX.loaded and not COMUNI_INDEX.has_id(comune_id):
+            return False, None
+        return True, {'id': comune_id, 'nome': comune_nome}
+
+    def put(self, nome, dominio, result):
+        with self._lock:
+            db = self._db()
+            db.execute(
+                'INSERT OR REPLACE INTO risoluzioni VALUES (?, ?, ?, ?, ?)',
+                (nome, dominio, result['id'] if result else None,
+                 result['nome'] if result else None, time.time())
+            )
+            db.commit()
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._evict(db)
+
+    def _evict(self, db):
+        """Elimina le voci più vecchie oltre il limite massimo"""
+        (count,) = db.execute('SELECT COUNT(*) FROM risoluzioni').fetchone()
+        if count > self.max_entries:
+            db.execute(
+                'DELETE FROM risoluzioni WHERE rowid IN '
+                '(SELECT rowid FROM risoluzioni ORDER BY creato LIMIT ?)',
+                (count - self.max_entries,)
+            )
+            db.commit()
+
+    def domain_resolutions(self):
+        """Risoluzioni positive non scadute per (dominio, comune): [(dominio, id, nome, n)]"""
+        with self._lock:
+            return self._db().execute(
+                'SELECT dominio, comune_id, MAX(comune_nome), COUNT(*) FROM risoluzioni '
+                "WHERE dominio != '' AND comune_id IS NOT NULL AND creato > ? "
+                'GROUP BY dominio, comune_id',
+                (time.time() - self.ttl,)
+            ).fetchall()
+
+    def invalidate(self, nome=None, dominio=None):
+        """Svuota la cache, o solo le voci di un nome (e dominio). Ritorna le voci rimosse"""
+        with self._lock:
+            db = self._db()
+            if nome is None:
+                cursor = db.execute('DELETE FROM risoluzioni')
+            elif dominio is None:
+                cursor = db.execute('DELETE FROM risoluzioni WHERE nome = ?', (nome,))
+            else:
+                cursor = db.execute('DELETE FROM risoluzioni WHERE nome = ? AND dominio = ?',
+                                    (nome, dominio))
+            db.commit()
+            return cursor.rowcount
+
+    def stats(self):
+        with self._lock:
+            db = self._db()
+            (total,) = db.execute('SELECT COUNT(*) FROM risoluzioni').fetchone()
+            (negative,) = db.execute(
+                'SELECT COUNT(*) FROM risoluzioni WHERE comune_id IS NULL').fetchone()
+        return {
+            'path': self.path,
+            'voci': total,
+            'negative': negative,
+            'max_voci': self.max_entries
+        }
+
+
+# Cache persistente condivisa tra importazioni e riavvii
+RESOLUTION_STORE = ResolutionStore(
+    RESOLUTION_CACHE_PATH,
+    RESOLUTION_CACHE_TTL,
+    RESOLUTION_CACHE_NEGATIVE_TTL,
+    RESOLUTION_CACHE_MAX_ENTRIES
+)
+
+# Indirizzi istituzionali: il nome del comune nel dominio (comune.barzano.lc.it,
+# comunedibarzano.it, comune-barzano.it, barzano.gov.it) o nella parte locale (comune.barzano@...)
+DOMINIO_COMUNE_RE = re.compile(r'^(?:comune\.([^.]+)\.|comunedi([^.]+)\.|comune-([^.]+)\.|([^.]+)\.gov\.it$)')
+LOCALE_COMUNE_RE = re.compile(r'comune\.([^.@]+)$')
+
+# Provider di posta generici: i loro domini non identificano un comune
+DOMINI_GENERICI = frozenset((
+    'gmail.com', 'googlemail.com', 'libero.it', 'virgilio.it', 'alice.it', 'tin.it',
+    'tiscali.it', 'hotmail.com', 'hotmail.it', 'outlook.com', 'outlook.it', 'live.com',
+    'live.it', 'msn.com', 'yahoo.com', 'yahoo.it', 'icloud.com', 'me.com', 'fastwebnet.it',
+    'email.it', 'inwind.it', 'iol.it', 'aruba.it', 'pec.it', 'legalmail.it', 'postacert.it',
+    'cert.legalmail.it', 'pec.aruba.it', 'arubapec.it', 'postecert.it', 'gigapec.it',
+))
+
+
+def comune_da_indirizzo(email):
+    """Nome del comune (grezzo, es. 'san-giovanni') da un indirizzo istituzionale, o None"""
+    locale, _, dominio = email.lower().rpartition('@')
+    match = DOMINIO_COMUNE_RE.match(dominio) or LOCALE_COMUNE_RE.search(locale)
+    if not match:
+        return None
+    return next(g for g in match.groups() if g)
+
+
+def slug_comune(nome):
+    """Nome normalizzato senza spazi, come compare nei domini: "San Giovanni" → "sangiovanni" """
+    return normalizza_nome_comune(nome).replace(' ', '')
+
+
+class DominiIndex:
+    """Indice dominio email → pagina comune, senza chiamate di rete.
+
+    Due fonti: le risoluzioni passate della cache persistente (un dominio non
+    generico che ha sempre portato allo stesso comune) e i nomi dell'indice
+    comuni, confrontati senza spazi con il nome estratto dagli indirizzi
+    istituzionali. L'estrazione usa un solo regex compilato ed è fatta una
+    volta per dominio: le righe successive con lo stesso dominio costano una
+    lettura da dizionario.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slugs = {}
+        self._slugs_version = None
+        self._appresi = {}
+        self._domini = {}
+
+    def __len__(self):
+        return len(self._appresi) + sum(1 for v in list(self._domini.values()) if v)
+
+    def build(self):
+        """Ricostruisce l'indice: slug dei comuni (se l'indice comuni è cambiato) e domini appresi"""
+        with self._lock:
+            if self._slugs_version != COMUNI_INDEX.loaded_at:
+                slugs = {}
+                for entry in COMUNI_INDEX.entries():
+                    slug = slug_comune(entry['nome'])
+                    # Due comuni con lo stesso slug: il dominio non basta a distinguerli
+                    slugs[slug] = None if slug in slugs else entry
+                self._slugs = slugs
+                self._slugs_version = COMUNI_INDEX.loaded_at
+
+            per_dominio = {}
+            try:
+                for dominio, comune_id, comune_nome, n in RESOLUTION_STORE.domain_resolutions():
+                    per_dominio.setdefault(dominio, []).append((comune_id, comune_nome, n))
+            except sqlite3.Error as e:
+                print(f"[CACHE] Errore lettura domini: {e}")
+            appresi = {}
+            for dominio, comuni in per_dominio.items():
+                if dominio in DOMINI_GENERICI or len(comuni) != 1:
+                    continue
+                comune_id, comune_nome, n = comuni[0]
+                if n >= DOMINI_MIN_RISOLUZIONI and (not COMUNI_INDEX.loaded or COMUNI_INDEX.has_id(comune_id)):
+                    appresi[dominio] = {'id': comune_id, 'nome': comune_nome}
+            self._appresi = appresi
+            self._domini = {}
+        print(f"[INDEX] Domini email: {len(appresi)} appresi, {len(self._slugs)} nomi di comuni")
+
+    def lookup(self, email):
+        """Ritorna {'id', 'nome'} del comune indicato dall'indirizzo email, o None"""
+        dominio = email_domain(email)
+        if not dominio:
+            return None
+        found = self._appresi.get(dominio)
+        if found:
+            return found
+        if dominio not in self._domini:
+            match = DOMINIO_COMUNE_RE.match(dominio)
+            self._domini[dominio] = self._slugs.get(slug_comune(next(g for g in match.groups() if g))) if match else None
+        found = self._domini[dominio]
+        if found is None:
+            # comune.barzano@gmail.com
+            match = LOCALE_COMUNE_RE.search(email.lower().rpartition('@')[0])
+            if match:
+                found = self._slugs.get(slug_comune(match.group(1)))
+        return found
+
+    def stats(self):
+        return {
+            'appresi': len(self._appresi),
+            'nomi': len(self._slugs),
+            'domini_visti': len(self._domini)
+        }
+
+
+# Indice domini email → comune (ricostruito all'inizio di ogni importazione)
+DOMINI_INDEX = DominiIndex()
+
+
+class ContattiIndex:
+    """Email primarie già presenti nel database Contatti (email → id pagina).
+
+    Viene scaricato una volta paginando `databases/{CONTATTI_DB_ID}/query` e
+    aggiornato a ogni contatto creato, così le righe già importate vengono
+    saltate senza chiamate API. È condiviso tra le importazioni e ricaricato
+    quando più vecchio di CONTATTI_INDEX_TTL.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._emails = {}
+        # Contatti creati mentre load() scarica l'elenco (None se nessun caricamento)
+        self._confirmed_during_load = None
+        self.loaded_at = None
+
+    @staticmethod
+    def normalize(email):
+        return email.strip().lower()
+
+    def load(self):
+        """Scarica tutte le email primarie del database Contatti"""
+        if not CONTATTI_DB_ID:
+            raise ValueError("CONTATTI_DB_ID non configurato")
+
+        start = time.time()
+        with self._lock:
+            self._confirmed_during_load = {}
+        emails = {}
+        cursor = None
+        try:
+            while True:
+                body = {'page_size': 100}
+                if cursor:
+                    body['start_cursor'] = cursor
+
+                data = notion_request('POST', f'databases/{CONTATTI_DB_ID}/query', body, timeout=30)
+
+                for result in data.get('results', []):
+                    title = result.get('properties', {}).get('Email primaria', {}).get('title', [])
+                    email = ''.join(t.get('plain_text', '') for t in title)
+                    if email.strip():
+                        emails.setdefault(self.normalize(email), result['id'])
+
+                if not data.get('has_more'):
+                    break
+                cursor = data.get('next_cursor')
+        except Exception:
+            with self._lock:
+                self._confirmed_during_load = None
+            raise
+
+        with self._lock:
+            # Mantiene le prenotazioni delle importazioni in corso (id None) e i
+            # contatti creati durante il download, che l'elenco può non includere;
+            # gli altri vengono dall'elenco (i contatti eliminati in Notion spariscono)
+            for email, page_id in self._emails.items():
+                if page_id is None:
+                    emails.setdefault(email, None)
+            emails.update(self._confirmed_during_load)
+            self._confirmed_during_load = None
+            self._emails = emails
+            self.loaded_at = time.time()
+
+        print(f"[CONTATTI] Email esistenti: {len(emails)} in {time.time() - start:.1f}s")
+
+    def ensure_fresh(self):
+        """Carica l'indice se assente o scaduto"""
+        with self._load_lock:
+            if self.loaded_at is None or time.time() - self.loaded_at > self.ttl:
+                self.load()
+
+    def reserve(self, email):
+        """Ritorna (esiste, id_pagina). Se l'email non esiste la prenota
+        (id None) così righe duplicate nello stesso file vengono saltate."""
+        key = self.normalize(email)
+        with self._lock:
+            if key in self._emails:
+                return True, self._emails[key]
+            self._emails[key] = None
+            return False, None
+
+    def get(self, email):
+        """Come reserve() ma senza prenotare l'email (simulazioni)"""
+        key = self.normalize(email)
+        with self._lock:
+            if key in self._emails:
+                return True, self._emails[key]
+            return False, None
+
+    def confirm(self, email, page_id):
+        key = self.normalize(email)
+        with self._lock:
+            self._emails[key] = page_id
+            if self._confirmed_during_load is not None:
+                self._confirmed_during_load[key] = page_id
+
+    def release(self, email):
+        """Annulla una prenotazione dopo una creazione fallita"""
+        key = self.normalize(email)
+        with self._lock:
+            if key in self._emails and self._emails[key] is None:
+                del self._emails[key]
+
+    def stats(self):
+        return {
+            'email': len(self._emails),
+            'loaded_at': datetime.fromtimestamp(self.loaded_at).isoformat(timespec='seconds')
+            if self.loaded_at else None
+        }
+
+
+# Indice condiviso delle email già presenti in Contatti
+CONTATTI_INDEX = ContattiIndex(CONTATTI_INDEX_TTL)
+
+# Comportamento per le email già presenti: salta, aggiorna la pagina o importa comunque
+DUPLICATI_MODES = ('skip', 'update', 'import')
+
+# Campi opzionali del contatto: chiave del mapping → (proprietà Notion, tipo)
+CONTACT_FIELDS = {
+    'nome': ('Nome e cognome', 'rich_text'),
+    'carica': ('Carica', 'rich_text'),
+    'indirizzo': ('Indirizzo', 'rich_text'),
+    'email2': ('Email 2', 'email'),
+    'email3': ('Email 3', 'email'),
+    'telefono': ('Telefono', 'phone_number'),
+    'cellulare': ('Cellulare', 'phone_number'),
+    'sito': ('Sito web', 'url'),
+}
+
+# Lunghezza massima di un testo accettata dall'API Notion
+NOTION_TEXT_LIMIT = 2000
+
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+def contact_field(row, mapping, field):
+    """Valore della colonna mappata su `field`, senza spazi ('' se non mappata,
+    assente o vuota). Usato sia da create_contact sia da validate_contact_row."""
+    column = mapping.get(field)
+    if not column:
+        return ''
+    return (row.get(column) or '').strip()
+
+
+def validate_contact_row(row, mapping):
+    """Controlla una riga con le stesse regole di create_contact.
+
+    Ritorna (errore, avvisi): `errore` è il motivo per cui la creazione
+    fallirebbe (o None), `avvisi` elenca i campi che verrebbero scartati o
+    che Notion potrebbe rifiutare.
+    """
+    email = contact_field(row, mapping, 'email')
+    if not email:
+        return 'Email mancante', []
+
+    avvisi = []
+    if not EMAIL_RE.match(email):
+        avvisi.append('email')
+    for field, (notion_field, field_type) in CONTACT_FIELDS.items():
+        value = contact_field(row, mapping, field)
+        if not value:
+            continue
+        if field_type == 'rich_text' and len(value) > NOTION_TEXT_LIMIT:
+            return f'{notion_field} oltre {NOTION_TEXT_LIMIT} caratteri', avvisi
+        if field_type == 'email' and not EMAIL_RE.match(value):
+            avvisi.append(field)
+        elif field_type == 'url':
+            parsed = urllib.parse.urlparse(
+                value if value.startswith(('http://', 'https://')) else 'https://' + value)
+            if not parsed.netloc or '.' not in parsed.netloc or any(c.isspace() for c in value):
+                avvisi.append(field)
+    return None, avvisi
+
+
+class ImportJournal:
+    """Journal append-only (JSONL) di un'importazione, identificato dall'hash del file.
+
+    Ogni riga elaborata viene registrata con esito e id della pagina Notion;
+    i dati vengono scritti su disco (fsync) ogni IMPORT_JOURNAL_SYNC_EVERY righe.
+    Se l'importazione si interrompe, ricaricare lo stesso file riprende dalle
+    righe non ancora completate.
+    """
+
+    # Esiti che non vanno ripetuti alla ripresa (gli errori sì)
+    DONE = ('creato', 'aggiornato', 'saltato')
+
+    def __init__(self, file_hash, directory=None):
+        self.file_hash = file_hash
+        self.path = os.path.join(directory or IMPORT_JOURNAL_DIR, f'{file_hash}.jsonl')
+        self.done_rows = set()
+        self._file = None
+        self._lock = threading.Lock()
+        self._unsynced = 0
+
+    def open(self, resume=True):
+        """Apre il journal; con `resume` recupera le righe già completate
+        da un'importazione precedente non terminata"""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+
+        completed = False
+        done_rows = set()
+        if resume and os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # ultima riga troncata da un crash
+                    if entry.get('fine'):
+                        completed = True
+                    elif entry.get('esito') in self.DONE:
+                        done_rows.add(entry['riga'])
+
+        if resume and done_rows and not completed:
+            self.done_rows = done_rows
+            self._file = open(self.path, 'a', encoding='utf-8')
+            print(f"[JOURNAL] Ripresa importazione {self.file_hash[:12]}: "
+                  f"{len(done_rows)} righe già completate")
+        else:
+            self._file = open(self.path, 'w', encoding='utf-8')
+            self._write({'hash': self.file_hash, 'inizio': datetime.now().isoformat(timespec='seconds')})
+        return self
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def record(self, row_num, result):
+        """Registra l'esito di una riga"""
+        if result.get('skipped'):
+            esito = 'saltato'
+        elif result.get('updated'):
+            esito = 'aggiornato'
+        elif result.get('success'):
+            esito = 'creato'
+        else:
+            esito = 'errore'
+
+        entry = {'riga': row_num, 'esito': esito}
+        if result.get('id'):
+            entry['page_id'] = result['id']
+        with self._lock:
+            self._write(entry)
+            self._unsynced += 1
+            if self._unsynced >= IMPORT_JOURNAL_SYNC_EVERY:
+                self._sync()
+
+    def close(self, completed):
+        """Chiude il journal; se completato, un nuovo caricamento riparte da zero"""
+        with self._lock:
+            if self._file is None:
+                return
+            if completed:
+                self._write({'fine': True, 'ora': datetime.now().isoformat(timespec='seconds')})
+            self._sync()
+            self._file.close()
+            self._file = None
+
+
+# Dimensione dei blocchi letti dal socket negli upload in streaming
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+# Campione iniziale usato per rilevare encoding e formato del CSV
+CSV_SAMPLE_SIZE = 64 * 1024
+
+# Separatori riconosciuti (gli export Excel italiani usano il punto e virgola)
+CSV_DELIMITERS = ',;\t|'
+
+# BOM riconosciuti, dal più lungo (UTF-32 inizia come UTF-16 LE)
+CSV_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+
+def detect_encoding(sample):
+    """Sceglie l'encoding del CSV a partire da un campione iniziale"""
+    for bom, encoding in CSV_BOMS:
+        if sample.startswith(bom):
+            return encoding
+    try:
+        # final=False: il campione può terminare a metà di un carattere multibyte
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        # Non latin-1: decodificherebbe senza errori anche un file cp1252
+        return 'cp1252'
+
+
+def detect_csv_format(sample):
+    """Rileva encoding, BOM, separatore e virgolette da un campione iniziale.
+
+    Il separatore viene scelto con csv.Sniffer sulle prime righe complete;
+    se lo sniffer fallisce (o sceglie un carattere assente nell'intestazione)
+    si usa il separatore più frequente nella prima riga.
+    """
+    encoding = detect_encoding(sample)
+    text = codecs.getincrementaldecoder(encoding)(errors='replace').decode(sample, final=False)
+    lines = text.splitlines()
+    if len(sample) >= CSV_SAMPLE_SIZE and len(lines) > 1:
+        lines.pop()  # probabilmente troncata
+    header = lines[0] if lines else ''
+    
+    delimiter, quotechar = None, '"'
+    try:
+        dialect = csv.Sniffer().sniff('\n'.join(lines[:20]), delimiters=CSV_DELIMITERS)
+        if dialect.delimiter in header:
+            delimiter = dialect.delimiter
+            quotechar = dialect.quotechar or '"'
+    except csv.Error:
+        pass
+    if delimiter is None:
+        # A parità vince la virgola (primo candidato)
+        delimiter = max(CSV_DELIMITERS, key=header.count)
+    
+    return {
+        'encoding': encoding,
+        'bom': any(sample.startswith(bom) for bom, _ in CSV_BOMS),
+        'delimiter': delimiter,
+        'quotechar': quotechar
+    }
+
+
+def csv_headers(sample, csv_format):
+    """Intestazioni del CSV lette dal campione con il formato rilevato"""
+    text = codecs.getincrementaldecoder(csv_format['encoding'])(errors='replace').decode(
+        sample, final=False)
+    reader = csv.reader(io.StringIO(text, newline=''),
+                        delimiter=csv_format['delimiter'], quotechar=csv_format['quotechar'])
+    return [h.strip() for h in next(reader, [])]
+
+
+class CSVFileRows:
+    """Righe (dict) di un CSV su disco, lette una alla volta.
+
+    A differenza di un generatore può essere iterato più volte (ogni
+    iterazione riapre il file), ad esempio per una passata di analisi
+    prima dell'importazione. Il file viene decodificato a blocchi con il
+    formato rilevato da detect_csv_format.
+    """
+
+    def __init__(self, path, encoding, delimiter=',', quotechar='"'):
+        self.path = path
+        self.encoding = encoding
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+
+    @classmethod
+    def from_format(cls, path, csv_format):
+        return cls(path, csv_format['encoding'],
+                   csv_format['delimiter'], csv_format['quotechar'])
+
+    def __iter__(self):
+        with open(self.path, 'r', encoding=self.encoding, errors='replace', newline='') as f:
+            # restval: nelle righe corte le colonne mancanti valgono '' (non None)
+            for row in csv.DictReader(f, delimiter=self.delimiter, quotechar=self.quotechar, restval=''):
+                yield row
+
+
+def ordered_map(executor, fn, items, window):
+    """Come executor.map ma con al massimo `window` elementi in volo.
+
+    Ritorna coppie (item, risultato) nell'ordine di `items`, consumando il
+    generatore di input solo quando si libera spazio.
+    """
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(fn, item)))
+        if len(pending) >= window:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+class ImportContext:
+    """Stato isolato di una singola importazione.
+
+    Ogni import ha la propria cache dei comuni, le proprie correzioni AI,
+    i contatori dei retry e il report dei risultati, così più importazioni
+    possono girare in parallelo senza interferire.
+    """
+
+    def __init__(self, mapping, duplicati='skip'):
+        self.mapping = mapping
+        self.duplicati = duplicati
+        # Esiti della ricerca: (nome in minuscolo, dominio email) → comune o None.
+        # Per coppia e non per nome: dominio email e OpenAI possono dare comuni diversi
+        self.comuni_cache = {}
+        # Esiti della fase di risoluzione: (nome in minuscolo, dominio email) → comune
+        self.risoluzioni = {}
+        # Ricerca esatta su Notion fatta in blocco (senza indice): nome in minuscolo → comune o None
+        self.notion_prefetch = {}
+        self.ai_corrections = []
+        self._corrections_seen = set()
+        self.retry_stats = RetryStats()
+        self.results = {
+            'success': 0,
+            'errors': [],
+            'comuni_corretti': [],
+            'comuni_non_trovati': [],
+            'contatti_non_importati': [],  # Nuova lista per contatti completi non importati
+            'saltati_esistenti': 0,
+            'aggiornati': 0
+        }
+        self.counters = {}
+        self.row_times = []
+        self._lock = threading.Lock()
+        self._name_locks = {}
+
+    def count(self, key, n=1):
+        """Incrementa un contatore dell'importazione"""
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def record_row_time(self, seconds):
+        """Registra la durata di elaborazione di una riga"""
+        with self._lock:
+            self.row_times.append(seconds)
+
+    def row_latency(self):
+        """Percentili della durata per riga in millisecondi (None se nessuna riga)"""
+        with self._lock:
+            times = sorted(self.row_times)
+        if not times:
+            return None
+
+        def percentile(p):
+            return round(times[min(len(times) - 1, int(len(times) * p))] * 1000, 1)
+
+        return {
+            'p50': percentile(0.50),
+            'p90': percentile(0.90),
+            'p99': percentile(0.99),
+            'max': round(times[-1] * 1000, 1)
+        }
+
+    def comune_lock(self, chiave):
+        """Lock per coppia (nome, dominio): un solo worker la risolve"""
+        with self._lock:
+            lock = self._name_locks.get(chiave)
+            if lock is None:
+                lock = self._name_locks[chiave] = threading.Lock()
+            return lock
+
+    def add_correction(self, originale, corretto, metodo=None, **extra):
+        """Registra una correzione del nome comune"""
+        correction = {
+            'originale': originale,
+            'corretto': corretto,
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        }
+        if metodo:
+            correction['metodo'] = metodo
+        correction.update(extra)
+        with self._lock:
+            # La stessa correzione può arrivare da più coppie nome/dominio
+            if (originale, corretto) in self._corrections_seen:
+                return
+            self._corrections_seen.add((originale, corretto))
+            self.ai_corrections.append(correction)
+
+
+class ImportJob:
+    """Importazione eseguita in background, con avanzamento consultabile"""
+
+    def __init__(self, total):
+        self.id = uuid.uuid4().hex[:12]
+        self.total = total
+        self.status = 'queued'
+        self.phase = None
+        self.processed = 0
+        self.results = None
+        self.error = None
+        self.created_at = datetime.now().isoformat(timespec='seconds')
+        self.started = None
+        self.finished = None
+        self.version = 0
+        self._cond = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status in ('completed', 'failed')
+
+    def _notify(self):
+        self.version += 1
+        self._cond.notify_all()
+
+    def start(self):
+        with self._cond:
+            self.status = 'running'
+            self.started = time.time()
+            self._notify()
+
+    def set_phase(self, phase):
+        """Fase corrente dell'importazione ('comuni' o 'scrittura')"""
+        with self._cond:
+            self.phase = phase
+            self._notify()
+
+    def update(self, processed, results):
+        with self._cond:
+            self.processed = processed
+            self.results = results
+            self._notify()
+
+    def finish(self, results):
+        with self._cond:
+            self.results = results
+            self.processed = self.total
+            self.status = 'completed'
+            self.finished = time.time()
+            self._notify()
+
+    def fail(self, error):
+        with self._cond:
+            self.error = error
+            self.status = 'failed'
+            self.finished = time.time()
+            self._notify()
+
+    def wait_for_update(self, version, timeout):
+        """Attende un aggiornamento successivo a `version` (o il timeout)"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version or self.done, timeout)
+            return self.version
+
+    def snapshot(self, include_results=False):
+        """Stato corrente: conteggi, velocità (righe/s) ed ETA in secondi"""
+        results = self.results or {}
+        elapsed = 0
+        if self.started:
+            elapsed = (self.finished or time.time()) - self.started
+        rate = self.processed / elapsed if elapsed > 0 else 0
+        eta = (self.total - self.processed) / rate if rate > 0 else None
+
+        data = {
+            'job_id': self.id,
+            'status': self.status,
+            'fase': self.phase,
+            'created_at': self.created_at,
+            'total': self.total,
+            'processed': self.processed,
+            'success': results.get('success', 0),
+            'errors': len(results.get('errors', [])),
+            'comuni_corretti': len(results.get('comuni_corretti', [])),
+            'comuni_non_trovati': len(results.get('comuni_non_trovati', [])),
+            'saltati_esistenti': results.get('saltati_esistenti', 0),
+            'elapsed': round(elapsed, 1),
+            'rows_per_sec': round(rate, 2),
+            'eta_seconds': round(eta) if eta is not None and not self.done else None
+        }
+        if self.error:
+            data['error'] = self.error
+        if include_results and self.status == 'completed':
+            data['results'] = self.results
+        return data
+
+
+# Job di importazione recenti (i più vecchi completati vengono rimossi)
+MAX_JOBS = 50
+JOBS = {}
+JOBS_LOCK = threading.Lock()
+
+
+def register_job(job):
+    with JOBS_LOCK:
+        JOBS[job.id] = job
+        finished = [j for j in JOBS.values() if j.done]
+        for old in sorted(finished, key=lambda j: j.finished)[:max(0, len(JOBS) - MAX_JOBS)]:
+            del JOBS[old.id]
+
+
+def get_job(job_id):
+    with JOBS_LOCK:
+        return JOBS.get(job_id)
+
+
+class ContactImporter:
+    """Pipeline di importazione dei contatti (comuni, pagine Notion, report).
+
+    Non dipende dalla richiesta HTTP: la usano sia CSVImportHandler, per i job
+    in background, sia l'importazione da riga di comando (cli_import).
+    """
+    
+    def run_import_job(self, job, rows, mapping, cleanup_path=None, options=None):
+        """Esegue l'importazione in un thread separato aggiornando il job"""
+        job.start()
+        METRICS.inc('csv_import_jobs_running')
+        try:
+            results = self.run_import(rows, mapping, job, total=job.total, options=options)
+            job.finish(results)
+        except Exception as e:
+            print(f"[IMPORT] ❌ Job {job.id} fallito: {e}")
+            traceback.print_exc()
+            job.fail(str(e))
+        finally:
+            METRICS.inc('csv_import_jobs_running', value=-1)
+            METRICS.inc('csv_import_jobs_total', {'status': job.status})
+            if cleanup_path and os.path.exists(cleanup_path):
+                os.remove(cleanup_path)
+    
+    def run_import(self, rows, mapping, job=None, total=None, options=None):
+        """Importa le righe in Notion e ritorna il report dei risultati.
+
+        `rows` può essere una lista o un CSVFileRows (upload in streaming): in
+        quel caso `total` indica il numero di righe atteso. `options` può
+        contenere `duplicati` ('skip', 'update' o 'import'), `file_hash`
+        (attiva il journal) e `resume` (riprende un'importazione interrotta).
+        """
+        options = options or {}
+        duplicati = options.get('duplicati') or 'skip'
+        if duplicati not in DUPLICATI_MODES:
+            raise ValueError(f"Opzione duplicati non valida: {duplicati}")
+        
+        # Stato dedicato a questa importazione
+        ctx = ImportContext(mapping, duplicati)
+        results = ctx.results
+        
+        # Email già presenti in Contatti: i duplicati non costano chiamate API
+        if duplicati != 'import':
+            CONTATTI_INDEX.ensure_fresh()
+
+        # Indice comuni in memoria: nessuna query Notion per riga
+        if COMUNI_INDEX.ensure_loaded():
+            DOMINI_INDEX.build()
+        
+        # Tracing per riga (opzionale): un file JSONL per job
+        tracer = None
+        if options.get('trace'):
+            tracer = JobTracer(job.id if job else uuid.uuid4().hex[:12])
+            print(f"[TRACE] Tracce delle righe in {tracer.path}")
+        
+        # Fase 1: ogni coppia (comune, dominio email) distinta viene risolta una volta
+        if job:
+            job.set_phase('comuni')
+        started = time.perf_counter()
+        try:
+            fase_comuni = self.pre_resolve_comuni(rows, mapping, ctx, tracer=tracer)
+        except Exception:
+            if tracer:
+                tracer.close()
+            raise
+        fase_comuni['secondi'] = round(time.perf_counter() - started, 2)
+        
+        # Fase 2: scrittura delle pagine, il comune di ogni riga è già noto
+        if job:
+            job.set_phase('scrittura')
+        write_started = time.perf_counter()
+        
+        # Import concorrente: i worker condividono il rate limiter Notion
+        total_rows = total if total is not None else len(rows)
+        print(f"[IMPORT] Worker: {IMPORT_WORKERS}, rate Notion: "
+              f"{NOTION_RATE_LIMITER.rate}/s (burst {NOTION_RATE_LIMITER.burst})")
+        
+        # Journal per riprendere l'importazione se il processo si interrompe
+        journal = None
+        if options.get('file_hash'):
+            journal = ImportJournal(options['file_hash']).open(options.get('resume', True))
+            if journal.done_rows:
+                results['ripresa'] = {'righe_completate': len(journal.done_rows)}
+        
+        def import_row(item):
+            row_num, row = item
+            trace = tracer.begin_row(row_num) if tracer else None
+            started = time.perf_counter()
+            try:
+                result = self.create_contact(row, mapping, ctx)
+            except Exception as e:
+                result = {'success': False, 'error': str(e)}
+            if tracer:
+                tracer.end_row(trace, result)
+            elapsed = time.perf_counter() - started
+            ctx.record_row_time(elapsed)
+            METRICS.observe('csv_import_stage_seconds', elapsed, {'stage': 'row'})
+            if result.get('skipped'):
+                esito = 'skipped'
+            elif result.get('updated'):
+                esito = 'updated'
+            else:
+                esito = 'success' if result.get('success') else 'error'
+            METRICS.inc('csv_import_rows_total', {'result': esito})
+            if journal:
+                journal.record(row_num, result)
+            return result
+        
+        numbered = enumerate(rows, start=1)
+        processed = 0
+        if journal and journal.done_rows:
+            done_rows = journal.done_rows
+            numbered = ((n, row) for n, row in numbered if n not in done_rows)
+            processed = len(done_rows)
+        
+        completed = False
+        try:
+            with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as executor:
+                # Risultati nell'ordine delle righe, con un numero limitato di righe in volo
+                for (row_num, row), result in ordered_map(
+                        executor, import_row, numbered, IMPORT_WORKERS * 4):
+                    processed += 1
+                    if processed % 10 == 0:
+                        print(f"[IMPORT] Riga {processed}/{total_rows}")
+                    
+                    try:
+                        self.record_row_result(results, row_num, row, mapping, result)
+                    except Exception as e:
+                        print(f"[IMPORT] Errore riga {row_num}: {e}")
+                        results['errors'].append({
+                            'row': row_num,
+                            'error': str(e)
+                        })
+                    
+                    if job:
+                        job.update(processed, results)
+            completed = True
+        finally:
+            if journal:
+                journal.close(completed)
+            if tracer:
+                results['trace'] = tracer.close()
+        
+        results['fasi'] = {
+            'comuni': fase_comuni,
+            'scrittura': {'secondi': round(time.perf_counter() - write_started, 2)}
+        }
+        results['retry'] = ctx.retry_stats.snapshot()
+        results['latenza_righe_ms'] = ctx.row_latency()
+        results['cache_risoluzioni'] = {
+            'hit': ctx.counters.get('cache_hit', 0),
+            'miss': ctx.counters.get('cache_miss', 0)
+        }
+        
+        print(f"[IMPORT] === COMPLETATO ===")
+        print(f"[IMPORT] Successi: {results['success']}")
+        print(f"[IMPORT] Errori: {len(results['errors'])}")
+        if results['saltati_esistenti']:
+            print(f"[IMPORT] Saltati (già presenti): {results['saltati_esistenti']}")
+        print(f"[IMPORT] Tempi: comuni {fase_comuni['secondi']}s, "
+              f"scrittura {results['fasi']['scrittura']['secondi']}s")
+        print(f"[IMPORT] Retry: {results['retry']['retries']} "
+              f"(rate limit: {results['retry']['rate_limited']})")
+        
+        # Aggiungi correzioni AI ai risultati
+        if ctx.ai_corrections:
+            print(f"\n[AI] === CORREZIONI CON INTELLIGENZA ARTIFICIALE ===")
+            print(f"[AI] Totale correzioni: {len(ctx.ai_corrections)}")
+            for corr in ctx.ai_corrections:
+                print(f"[AI] {corr['timestamp']} - '{corr['originale']}' → '{corr['corretto']}'")
+            results['ai_corrections'] = ctx.ai_corrections
+        
+        return results
+    
+    def plan_import(self, rows, mapping, options=None):
+        """Simulazione (dry run): valida e risolve tutto senza scrivere su Notion.
+
+        Esegue gli stessi controlli di create_contact, classifica i comuni
+        distinti per metodo di risoluzione (cache, esatto, fuzzy, email,
+        OpenAI) senza chiamare OpenAI e stima chiamate API e durata
+        dell'importazione reale con il rate Notion configurato.
+        """
+        options = options or {}
+        duplicati = options.get('duplicati') or 'skip'
+        if duplicati not in DUPLICATI_MODES:
+            raise ValueError(f"Opzione duplicati non valida: {duplicati}")
+        
+        start = time.time()
+        if duplicati != 'import':
+            CONTATTI_INDEX.ensure_fresh()
+        if COMUNI_INDEX.ensure_loaded():
+            DOMINI_INDEX.build()
+        openai_enabled = bool(OPENAI_API_KEY and OPENAI_API_KEY.startswith('sk-'))
+        
+        righe = {'totali': 0, 'valide': 0, 'non_valide': 0,
+                 'da_creare': 0, 'da_aggiornare': 0, 'gia_presenti': 0,
+                 'duplicate_nel_file': 0}
+        errori = []
+        campi_scartati = {}
+        # Come la fase dei comuni: una risoluzione per coppia (nome, dominio email)
+        comuni = {}
+        nomi_notion = set()
+        metodi = {'cache': 0, 'esatto': 0, 'fuzzy': 0, 'email': 0,
+                  'openai': 0, 'notion': 0, 'non_trovato': 0}
+        esempi = {'openai': [], 'non_trovato': []}
+        emails_file = set()
+        
+        for row_num, row in enumerate(rows, start=1):
+            righe['totali'] += 1
+            errore, avvisi = validate_contact_row(row, mapping)
+            for field in avvisi:
+                campi_scartati[field] = campi_scartati.get(field, 0) + 1
+            if errore:
+                righe['non_valide'] += 1
+                if len(errori) < 100:
+                    errori.append({'row': row_num, 'error': errore})
+                continue
+            righe['valide'] += 1
+            
+            # Duplicati: stessa logica di create_contact, senza prenotare le email
+            email = contact_field(row, mapping, 'email')
+            key = ContattiIndex.normalize(email)
+            if duplicati != 'import':
+                if key in emails_file:
+                    righe['duplicate_nel_file'] += 1
+                    continue
+                emails_file.add(key)
+                exists, page_id = CONTATTI_INDEX.get(email)
+                if exists:
+                    if duplicati == 'update' and page_id:
+                        righe['da_aggiornare'] += 1
+                    else:
+                        righe['gia_presenti'] += 1
+                        continue
+                else:
+                    righe['da_creare'] += 1
+            else:
+                righe['da_creare'] += 1
+            
+            nome = contact_field(row, mapping, 'comune')
+            chiave = (nome.lower(), email_domain(email))
+            if not nome or chiave in comuni:
+                continue
+            
+            try:
+                hit, _ = RESOLUTION_STORE.get(*chiave)
+            except sqlite3.Error:
+                hit = False
+            if hit:
+                metodo = 'cache'
+            elif not COMUNI_INDEX.loaded:
+                metodo = 'notion'
+                nomi_notion.add(chiave[0])
+            else:
+                metodo = self.local_resolution(nome, email)[0]
+                if not metodo:
+                    metodo = 'openai' if openai_enabled else 'non_trovato'
+            comuni[chiave] = metodo
+            metodi[metodo] += 1
+            if metodo in esempi and len(esempi[metodo]) < 20 and nome not in esempi[metodo]:
+                esempi[metodo].append(nome)
+        
+        # Stima: una chiamata per pagina creata o aggiornata e, se l'indice comuni
+        # non è disponibile, le query `equals` in blocco (per nome) più una
+        # `contains` per coppia
+        notion_calls = (righe['da_creare'] + righe['da_aggiornare']
+                        + -(-len(nomi_notion) // NOTION_FILTER_BATCH) + metodi['notion'])
+        openai_calls = -(-metodi['openai'] // OPENAI_BATCH_SIZE)
+        # Rate configurato (NOTION_RATE), non quello ridotto da un 429 recente
+        eta = notion_calls / NOTION_RATE_LIMITER.max_rate if NOTION_RATE_LIMITER.max_rate else None
+        
+        plan = {
+            'righe': righe,
+            'errori': errori,
+            'campi_scartati': campi_scartati,
+            'comuni': {
+                'distinti': len({nome_lower for nome_lower, _ in comuni}),
+                'coppie': len(comuni),
+                'metodi': metodi,
+                'esempi': esempi
+            },
+            'chiamate_previste': {
+                'notion': notion_calls,
+                'openai': openai_calls,
+                'per_riga': round(notion_calls / righe['totali'], 2) if righe['totali'] else 0
+            },
+            'rate_notion': NOTION_RATE_LIMITER.max_rate,
+            'eta_secondi': round(eta) if eta is not None else None,
+            'durata_simulazione': round(time.time() - start, 2)
+        }
+        
+        print(f"[PIANO] Righe: {righe['totali']} (non valide: {righe['non_valide']}, "
+              f"già presenti: {righe['gia_presenti']})")
+        print(f"[PIANO] Comuni distinti: {plan['comuni']['distinti']} "
+              f"({len(comuni)} coppie nome/dominio) {metodi}")
+        print(f"[PIANO] Chiamate previste: Notion {notion_calls}, OpenAI {openai_calls}, "
+              f"ETA {plan['eta_secondi']}s")
+        return plan
+    
+    def record_row_result(self, results, row_num, row, mapping, result):
+        """Aggiunge l'esito di una riga al report dell'importazione"""
+        if result.get('skipped'):
+            results['saltati_esistenti'] += 1
+            return
+        
+        if result.get('success'):
+            results['success'] += 1
+            if result.get('updated'):
+                results['aggiornati'] += 1
+            
+            if result.get('comune_corretto'):
+                results['comuni_corretti'].append({
+                    'originale': result['comune_originale'],
+                    'corretto': result['comune_corretto']
+                })
+            elif result.get('comune_non_trovato'):
+                if result['comune_non_trovato'] not in results['comuni_non_trovati']:
+                    results['comuni_non_trovati'].append(result['comune_non_trovato'])
+                
+                # Aggiungi il contatto completo non importato
+                contact_data = {}
+                for field, column in mapping.items():
+                    if column in row:
+                        contact_data[field] = row[column].strip()
+                contact_data['_comune_non_trovato'] = result['comune_non_trovato']
+                contact_data['_row_number'] = row_num
+                results['contatti_non_importati'].append(contact_data)
+        else:
+            results['errors'].append({
+                'row': row_num,
+                'error': result.get('error', 'Errore sconosciuto')
+            })
+            
+            # Aggiungi anche agli errori il contatto completo
+            contact_data = {}
+            for field, column in mapping.items():
+                if column in row:
+                    contact_data[field] = row[column].strip()
+            contact_data['_error'] = result.get('error', 'Errore sconosciuto')
+            contact_data['_row_number'] = row_num
+            if contact_data not in results['contatti_non_importati']:
+                results['contatti_non_importati'].append(contact_data)
+    
+    def extract_comune_from_email(self, email):
+        """Estrae il possibile nome del comune dall'email"""
+        if not email:
+            return None
+            
+        with trace_stage('email_hint'):
+            comune = comune_da_indirizzo(email)
+            if comune:
+                # Rimuovi caratteri speciali e capitalizza
+                comune = comune.replace('-', ' ').replace('_', ' ')
+                comune = ' '.join(word.capitalize() for word in comune.split())
+                print(f"[EMAIL] Estratto comune dall'email: {comune}")
+                return comune
+                
+        return None
+    
+    def local_resolution(self, nome, email_hint):
+        """Risolve il comune solo con l'indice in memoria.
+
+        Ritorna (metodo, comune) con metodo 'esatto', 'email' o 'fuzzy',
+        oppure (None, None) se servirebbe OpenAI.
+        """
+        found = COMUNI_INDEX.lookup(nome)
+        if found:
+            return 'esatto', found
+        found = DOMINI_INDEX.lookup(email_hint) if email_hint else None
+        if found:
+            return 'email', found
+        match = COMUNI_INDEX.best_match(nome)
+        if match:
+            return 'fuzzy', {'id': match['id'], 'nome': match['nome']}
+        return None, None
+    
+    def resolves_locally(self, nome, email_hint):
+        """True se il comune si risolve senza OpenAI (indice, fuzzy o email)"""
+        return self.local_resolution(nome, email_hint)[0] is not None
+    
+    def collect_comune_pairs(self, rows, mapping, skip_existing=False):
+        """Coppie distinte (nome comune in minuscolo, dominio email) della colonna comune.
+
+        Con `skip_existing` ignora le righe con un'email già presente in Contatti
+        (verranno saltate). Ritorna un dict ordinato come il file:
+        coppia → (nome, email) della prima riga.
+        """
+        comune_column = mapping.get('comune')
+        email_column = mapping.get('email', '')
+        pairs = {}
+        if not comune_column:
+            return pairs
+        for row in rows:
+            nome = (row.get(comune_column) or '').strip()
+            if not nome:
+                continue
+            email = (row.get(email_column) or '').strip()
+            key = (nome.lower(), email_domain(email))
+            if key in pairs or (skip_existing and CONTATTI_INDEX.get(email)[0]):
+                continue
+            pairs[key] = (nome, email)
+        return pairs
+    
+    def pre_resolve_comuni(self, rows, mapping, ctx, tracer=None):
+        """Fase di risoluzione dei comuni, prima della creazione delle pagine.
+
+        Ogni coppia (nome, dominio email) distinta viene risolta una sola volta:
+        prima la correzione AI in blocco dei nomi non risolvibili localmente,
+        poi la risoluzione vera e propria in parallelo. Gli esiti finiscono in
+        ctx.risoluzioni, così nella fase di scrittura ogni riga fa solo una
+        lettura da dizionario. Le coppie rimaste senza esito (errori di rete)
+        vengono risolte riga per riga come prima. Con `tracer` la correzione in
+        blocco e ogni coppia hanno la propria traccia nel JSONL del job.
+        Ritorna le statistiche della fase.
+        """
+        with trace_stage('comune_preresolve'):
+            pairs = self.collect_comune_pairs(rows, mapping, skip_existing=ctx.duplicati == 'skip')
+            nomi = len({nome_lower for nome_lower, _ in pairs})
+            if pairs:
+                print(f"[COMUNE] Risoluzione di {nomi} nomi distinti ({len(pairs)} coppie nome/dominio)")
+            
+            trace = tracer.begin_comune('comuni_blocco', coppie=len(pairs)) if tracer and pairs else None
+            try:
+                # Correzione AI in blocco dei nomi che non si risolvono localmente
+                self.correct_unresolved_comuni(pairs, ctx)
+                
+                # Senza indice in memoria: ricerca esatta di tutti i nomi con poche query
+                if pairs and not COMUNI_INDEX.loaded:
+                    self.prefetch_comuni_on_notion(pairs, ctx)
+            finally:
+                if trace:
+                    tracer.end_comune(trace, 'completato')
+            
+            def resolve(item):
+                (nome_lower, dominio), (nome, email) = item
+                trace = tracer.begin_comune('comune', comune=nome, dominio=dominio) if tracer else None
+                esito = 'errore'
+                try:
+                    found = self.search_comune_on_notion(nome, ctx, email_hint=email)
+                    # Solo le risoluzioni completate (lookup_comune non memorizza gli errori di rete)
+                    if (nome_lower, dominio) in ctx.comuni_cache:
+                        ctx.risoluzioni[(nome_lower, dominio)] = found
+                        esito = 'risolto' if found else 'non_trovato'
+                except Exception as e:
+                    print(f"[COMUNE] Errore risoluzione {nome}: {e}")
+                finally:
+                    if trace:
+                        tracer.end_comune(trace, esito)
+            
+            with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as executor:
+                list(executor.map(resolve, pairs.items()))
+        
+        risolti = sum(1 for found in ctx.risoluzioni.values() if found)
+        return {
+            'nomi': nomi,
+            'coppie': len(pairs),
+            'risolte': risolti,
+            'non_trovate': len(ctx.risoluzioni) - risolti,
+            'da_risolvere_per_riga': len(pairs) - len(ctx.risoluzioni)
+        }
+    
+    def prefetch_comuni_on_notion(self, pairs, ctx):
+        """Ricerca esatta in blocco (find_comuni_on_notion) dei nomi non in cache.
+
+        Gli esiti vanno in ctx.notion_prefetch: lookup_comune li usa al posto
+        della query `equals` per singolo nome.
+        """
+        nomi = {}
+        for (nome_lower, dominio), (nome, _) in pairs.items():
+            if nome_lower in nomi or (nome_lower, dominio) in ctx.comuni_cache:
+                continue
+            try:
+                hit, _ = RESOLUTION_STORE.get(nome_lower, dominio)
+            except sqlite3.Error:
+                hit = False
+            if not hit:
+                nomi[nome_lower] = nome
+        if not nomi:
+            return
+        
+        richieste = -(-len(nomi) // NOTION_FILTER_BATCH)
+        print(f"[COMUNE] Ricerca di {len(nomi)} nomi su Notion in {richieste} query")
+        try:
+            found = find_comuni_on_notion(nomi.values(), stats=ctx.retry_stats)
+        except APIError as e:
+            # I nomi verranno cercati uno per uno
+            print(f"[COMUNE] Errore ricerca in blocco: {e}")
+            return
+        for nome_lower, nome in nomi.items():
+            ctx.notion_prefetch[nome_lower] = found.get(nome)
+    
+    def correct_unresolved_comuni(self, pairs, ctx):
+        """Corregge con OpenAI, in poche richieste, tutti i nomi non risolvibili localmente.
+
+        Tra le coppie di collect_comune_pairs raccoglie i nomi distinti che non
+        si trovano nell'indice (né esatti, né dall'email, né fuzzy), li invia a
+        blocchi di OPENAI_BATCH_SIZE con risposta JSON e verifica ogni
+        suggerimento sull'indice. Gli esiti finiscono nella cache
+        dell'importazione, così nessun nome chiama OpenAI da solo.
+        """
+        if not pairs or not COMUNI_INDEX.loaded:
+            return
+        if not OPENAI_API_KEY or not OPENAI_API_KEY.startswith('sk-'):
+            return
+        
+        pending = {}
+        for chiave, (nome, email) in pairs.items():
+            if chiave in ctx.comuni_cache:
+                continue
+            try:
+                hit, _ = RESOLUTION_STORE.get(*chiave)
+            except sqlite3.Error:
+                hit = False
+            if hit or self.resolves_locally(nome, email):
+                continue
+            pending[chiave] = (nome, email)
+        
+        if not pending:
+            return
+        
+        items = list(pending.items())
+        print(f"[OPENAI] Correzione in blocco di {len(items)} nomi "
+              f"({-(-len(items) // OPENAI_BATCH_SIZE)} richieste)")
+        
+        for start in range(0, len(items), OPENAI_BATCH_SIZE):
+            batch = items[start:start + OPENAI_BATCH_SIZE]
+            suggestions = self.openai_correct_batch([item for _, item in batch], ctx)
+            if suggestions is None:
+                # Richiesta fallita: quei nomi seguiranno il percorso riga per riga
+                continue
+            
+            for i, (chiave, (nome, email)) in enumerate(batch):
+                suggested = suggestions.get(i)
+                found = None
+                if suggested:
+                    match = COMUNI_INDEX.lookup(suggested) or COMUNI_INDEX.best_match(suggested)
+                    if match:
+                        found = {'id': match['id'], 'nome': match['nome']}
+                if found:
+                    print(f"[OPENAI] '{nome}' → '{found['nome']}'")
+                    ctx.add_correction(nome, found['nome'], metodo='openai_batch')
+                else:
+                    print(f"[COMUNE] ✗ Non trovato: {nome}")
+                ctx.comuni_cache[chiave] = found
+                try:
+                    RESOLUTION_STORE.put(*chiave, found)
+                except sqlite3.Error as e:
+                    print(f"[CACHE] Errore scrittura: {e}")
+    
+    def openai_correct_batch(self, batch, ctx):
+        """Una richiesta OpenAI per un blocco di (nome, email).
+
+        Ritorna {indice: nome corretto} (solo per i nomi corretti) oppure None
+        se la richiesta fallisce.
+        """
+        elenco = [{'id': i, 'nome': nome, 'email': email or None}
+                  for i, (nome, email) in enumerate(batch)]
+        
+        prompt = f"""Per ciascun elemento dell'elenco JSON seguente fornisci il nome corretto del comune italiano.
+I nomi possono avere errori di battitura, abbreviazioni o varianti; l'email associata può contenere il nome del comune.
+Se un nome non è un comune italiano valido usa "NON_TROVATO".
+
+Esempi di correzioni:
+- "S. Giovanni" → "San Giovanni"
+- "Barzano'" → "Barzanò"
+- "Male'" → "Malè"
+- "Baselga Di Pine'" → "Baselga di Pinè"
+
+Rispondi SOLO con un oggetto JSON nel formato {{"risultati": [{{"id": 0, "corretto": "..."}}]}}.
+
+Elenco:
+{json.dumps(elenco, ensure_ascii=False)}"""
+        
+        body = {
+            'model': 'gpt-4o-mini',
+            'messages': [
+                {'role': 'system', 'content': 'Sei un esperto di geografia italiana. Rispondi solo in JSON.'},
+                {'role': 'user', 'content': prompt}
+            ],
+            'temperature': 0.1,
+            'max_tokens': 40 * len(batch) + 100,
+            'response_format': {'type': 'json_object'}
+        }
+        
+        try:
+            data = openai_request(body, timeout=60, stats=ctx.retry_stats)
+            content = json.loads(data['choices'][0]['message']['content'])
+        except APIError as e:
+            print(f"[OPENAI] Errore correzione in blocco: {e}")
+            return None
+        except (ValueError, KeyError, IndexError) as e:
+            print(f"[OPENAI] Risposta non valida: {e}")
+            return None
+        
+        suggestions = {}
+        for item in content.get('risultati', []):
+            try:
+                idx = int(item.get('id'))
+            except (TypeError, ValueError):
+                continue
+            corretto = (item.get('corretto') or '').strip()
+            if 0 <= idx < len(batch) and corretto and corretto != 'NON_TROVATO':
+                suggestions[idx] = corretto
+        return suggestions
+    
+    def search_comune_with_openai(self, nome_originale, ctx, email_hint=None):
+        """Usa OpenAI per trovare varianti del nome comune.
+
+        Restituisce None se il nome non è un comune (NON_TROVATO); solleva
+        APIError se la chiamata fallisce, così l'esito non viene memorizzato.
+        """
+        if not OPENAI_API_KEY or not OPENAI_API_KEY.startswith('sk-'):
+            return None
+            
+        # Prima prova a estrarre il comune dall'email (con l'indice caricato
+        # l'ha già fatto DOMINI_INDEX in lookup_comune)
+        if email_hint and not COMUNI_INDEX.loaded:
+            extracted_comune = self.extract_comune_from_email(email_hint)
+            if extracted_comune:
+                print(f"[OPENAI] Provo prima con comune estratto dall'email: {extracted_comune}")
+                # Verifica se il comune estratto esiste
+                test_result = self.search_comune_on_notion_direct(extracted_comune, ctx)
+                if test_result:
+                    print(f"[OPENAI] Comune trovato dall'email: {extracted_comune}")
+                    ctx.add_correction(nome_originale, extracted_comune, metodo='email')
+                    return extracted_comune
+        
+        try:
+            # Aggiungi hint dall'email se disponibile
+            email_info = ""
+            if email_hint:
+                email_info = f"\nEmail associata (potrebbe contenere il nome del comune): {email_hint}"
+            
+            prompt = f"""Il seguente nome di comune italiano potrebbe avere errori di battitura, abbreviazioni o varianti.
+Fornisci SOLO il nome corretto del comune italiano, senza spiegazioni aggiuntive.
+Se non è un comune italiano valido, rispondi solo con "NON_TROVATO".
+
+Nome da correggere: {nome_originale}{email_info}
+
+Esempi di correzioni:
+- "S. Giovanni" → "San Giovanni"
+- "Barzano'" → "Barzanò"
+- "Male'" → "Malè"
+- "Baselga Di Pine'" → "Baselga di Pinè"
+
+Se l'email contiene "comune.barzano" o simili, il comune è probabilmente "Barzanò".
+
+Risposta:"""
+            
+            body = {
+                'model': 'gpt-4o-mini',  # Cambiato a modello esistente
+                'messages': [
+                    {'role': 'system', 'content': 'Sei un esperto di geografia italiana. Rispondi SOLO con il nome corretto del comune o "NON_TROVATO".'},
+                    {'role': 'user', 'content': prompt}
+                ],
+                'temperature': 0.1,
+                'max_tokens': 50
+            }
+            
+            data = openai_request(body, timeout=10, stats=ctx.retry_stats)
+            suggested_name = data['choices'][0]['message']['content'].strip()
+            
+            if suggested_name and suggested_name != 'NON_TROVATO':
+                print(f"[OPENAI] Suggerimento per '{nome_originale}': '{suggested_name}'")
+                # Registra la correzione
+                ctx.add_correction(nome_originale, suggested_name)
+                return suggested_name
+                    
+            return None
+            
+        except APIError as e:
+            error_body = e.body or 'No error body'
+            print(f"[OPENAI] Errore: {e}")
+            print(f"[OPENAI] Dettagli: {error_body}")
+            
+            # Se il problema è il modello, suggerisci alternative
+            if 'model' in error_body.lower():
+                print("[OPENAI] Nota: Il modello potrebbe non essere disponibile. Modelli validi: gpt-4o-mini, gpt-4o, gpt-3.5-turbo")
+            raise
+        except Exception as e:
+            print(f"[OPENAI] Errore generico: {e}")
+            import traceback
+            traceback.print_exc()
+            raise APIError(f"Risposta OpenAI non valida: {e}") from e
+    
+    def search_comune_on_notion(self, nome, ctx, email_hint=None):
+        """Cerca comune su Notion"""
+        if not nome or not nome.strip():
+            return None
+            
+        nome = nome.strip()
+        nome_lower = nome.lower()
+        dominio = email_domain(email_hint)
+        chiave = (nome_lower, dominio)
+        
+        # Cache check (per coppia nome/dominio, come la cache persistente)
+        cache = ctx.comuni_cache
+        if chiave in cache:
+            METRICS.inc('csv_import_comune_cache_total', {'cache': 'import', 'result': 'hit'})
+            trace_annotate(cache='import')
+            return cache[chiave]
+        
+        # Un solo worker risolve la stessa coppia, gli altri attendono la cache
+        with ctx.comune_lock(chiave):
+            if chiave in cache:
+                METRICS.inc('csv_import_comune_cache_total', {'cache': 'import', 'result': 'hit'})
+                trace_annotate(cache='import')
+                return cache[chiave]
+            METRICS.inc('csv_import_comune_cache_total', {'cache': 'import', 'result': 'miss'})
+            
+            # Cache persistente (risoluzioni di importazioni precedenti)
+            try:
+                hit, stored = RESOLUTION_STORE.get(nome_lower, dominio)
+            except sqlite3.Error as e:
+                print(f"[CACHE] Errore lettura: {e}")
+                hit, stored = False, None
+            if hit:
+                ctx.count('cache_hit')
+                METRICS.inc('csv_import_comune_cache_total', {'cache': 'persistent', 'result': 'hit'})
+                trace_annotate(cache='persistent')
+                cache[chiave] = stored
+                return stored
+            ctx.count('cache_miss')
+            METRICS.inc('csv_import_comune_cache_total', {'cache': 'persistent', 'result': 'miss'})
+            trace_annotate(cache='miss')
+            
+            result = self.lookup_comune(nome, chiave, ctx, email_hint)
+            
+            # Si memorizza solo una risoluzione completata (non gli errori di rete)
+            if chiave in cache:
+                try:
+                    RESOLUTION_STORE.put(nome_lower, dominio, cache[chiave])
+                except sqlite3.Error as e:
+                    print(f"[CACHE] Errore scrittura: {e}")
+            return result
+    
+    def lookup_comune(self, nome, chiave, ctx, email_hint=None):
+        """Risolve il comune (indice, Notion, OpenAI) senza controllare la cache.
+
+        L'esito va in ctx.comuni_cache sotto `chiave` (nome in minuscolo,
+        dominio email), perché può dipendere dall'email della riga.
+        """
+        nome_lower = chiave[0]
+        # Indice in memoria: se caricato, niente query equals/contains
+        if COMUNI_INDEX.loaded:
+            found = COMUNI_INDEX.lookup(nome)
+            if found:
+                trace_annotate(metodo='indice')
+                ctx.comuni_cache[chiave] = found
+                return found
+            
+            # Dominio email istituzionale o già visto: nessuna chiamata di rete
+            if email_hint:
+                with trace_stage('email_hint'):
+                    found = DOMINI_INDEX.lookup(email_hint)
+                if found:
+                    trace_annotate(metodo='email')
+                    print(f"[COMUNE] ✓ Trovato dall'email: {nome} → {found['nome']}")
+                    ctx.add_correction(nome, found['nome'], metodo='email')
+                    ctx.comuni_cache[chiave] = found
+                    return found
+            
+            # Match approssimato locale prima di ricorrere a OpenAI
+            match = COMUNI_INDEX.best_match(nome)
+            if match:
+                trace_annotate(metodo='fuzzy')
+                print(f"[COMUNE] ✓ Trovato (fuzzy locale {match['score']}): {nome} → {match['nome']}")
+                ctx.add_correction(nome, match['nome'], metodo='fuzzy', score=match['score'])
+                found = {'id': match['id'], 'nome': match['nome']}
+                ctx.comuni_cache[chiave] = found
+                return found
+            
+            return self.resolve_comune_fallback(nome, chiave, ctx, email_hint)
+        
+        try:
+            # Ricerca esatta (già fatta in blocco nella fase dei comuni, se possibile)
+            if nome_lower in ctx.notion_prefetch:
+                found = ctx.notion_prefetch[nome_lower]
+            else:
+                found = find_comuni_on_notion([nome], stats=ctx.retry_stats).get(nome)
+            if found:
+                ctx.comuni_cache[chiave] = found
+                print(f"[COMUNE] ✓ Trovato: {found['nome']}")
+                return found
+            
+            # Ricerca fuzzy
+            body = {
+                'filter': {
+                    'property': 'Name',
+                    'title': {'contains': nome}
+                },
+                'page_size': 10
+            }
+            
+            with trace_stage('notion_comune_query'):
+                data = notion_request('POST', f'databases/{COMUNI_DB_ID}/query', body, stats=ctx.retry_stats)
+            
+            # Match case-insensitive
+            for result in data['results']:
+                comune_nome = result['properties']['Name']['title'][0]['plain_text']
+                if comune_nome.lower() == nome_lower:
+                    comune_id = result['id']
+                    ctx.comuni_cache[chiave] = {'id': comune_id, 'nome': comune_nome}
+                    print(f"[COMUNE] ✓ Trovato (fuzzy): {comune_nome}")
+                    return {'id': comune_id, 'nome': comune_nome}
+            
+            # Best match
+            if len(data['results']) == 1:
+                result = data['results'][0]
+                comune_id = result['id']
+                comune_nome = result['properties']['Name']['title'][0]['plain_text']
+                ctx.comuni_cache[chiave] = {'id': comune_id, 'nome': comune_nome}
+                print(f"[COMUNE] ✓ Trovato (unico): {comune_nome}")
+                return {'id': comune_id, 'nome': comune_nome}
+            
+            return self.resolve_comune_fallback(nome, chiave, ctx, email_hint)
+            
+        except Exception as e:
+            print(f"[COMUNE] Errore: {e}")
+            return None
+    
+    def resolve_comune_fallback(self, nome, chiave, ctx, email_hint=None):
+        """Ultimo tentativo quando la ricerca diretta fallisce: email e OpenAI"""
+        trace_annotate(metodo='fallback')
+        # Se non trovato, prova con OpenAI per trovare varianti
+        print(f"[COMUNE] Non trovato direttamente, provo con OpenAI: {nome}")
+        if email_hint:
+            print(f"[COMUNE] Email hint: {email_hint}")
+        try:
+            suggested_name = self.search_comune_with_openai(nome, ctx, email_hint)
+        except APIError:
+            # Chiamata fallita (non un NON_TROVATO): nessuna cache né store,
+            # il nome verrà ritentato dalla prossima riga o importazione
+            print(f"[COMUNE] ✗ Non risolto (OpenAI non disponibile): {nome}")
+            return None
+        
+        if suggested_name:
+            # Riprova la ricerca con il nome suggerito
+            print(f"[COMUNE] Riprovo con nome suggerito: {suggested_name}")
+            suggested_result = self.search_comune_on_notion_direct(suggested_name, ctx)
+            if suggested_result:
+                ctx.comuni_cache[chiave] = suggested_result
+                return suggested_result
+        
+        print(f"[COMUNE] ✗ Non trovato: {nome}")
+        ctx.comuni_cache[chiave] = None
+        return None
+    
+    def search_comune_on_notion_direct(self, nome, ctx):
+        """Ricerca diretta su Notion senza cache o OpenAI"""
+        if COMUNI_INDEX.loaded:
+            found = COMUNI_INDEX.lookup(nome)
+            if found:
+                print(f"[COMUNE] ✓ Trovato nell'indice: {nome} → {found['nome']}")
+            return found
+        
+        try:
+            # Ricerca esatta
+            found = find_comuni_on_notion([nome], stats=ctx.retry_stats).get(nome)
+            if found:
+                print(f"[COMUNE] ✓ Trovato con OpenAI: {nome} → {found['nome']}")
+            return found
+            
+        except Exception as e:
+            print(f"[COMUNE] Errore ricerca diretta: {e}")
+            return None
+
+    def create_contact(self, row, mapping, ctx):
+        """Crea contatto in Notion"""
+        reserved_email = None
+        try:
+            # Email obbligatoria
+            email = contact_field(row, mapping, 'email')
+            
+            if not email:
+                return {'success': False, 'error': f'Email mancante'}
+            
+            # Email già presente in Contatti (o già creata in questa importazione)
+            existing_id = None
+            if ctx.duplicati != 'import':
+                exists, existing_id = CONTATTI_INDEX.reserve(email)
+                if not exists:
+                    reserved_email = email
+                elif ctx.duplicati == 'skip' or not existing_id:
+                    return {'success': True, 'skipped': True, 'id': existing_id}
+            
+            # Proprietà base
+            properties = {
+                'Email primaria': {
+                    'title': [{'text': {'content': email}}]
+                }
+            }
+            
+            # Altri campi
+            for field, (notion_field, field_type) in CONTACT_FIELDS.items():
+                value = contact_field(row, mapping, field)
+                if value:
+                    if field_type == 'rich_text':
+                        properties[notion_field] = {
+                            'rich_text': [{'text': {'content': value}}]
+                        }
+                    elif field_type == 'email' and '@' in value:
+                        properties[notion_field] = {'email': value}
+                    elif field_type == 'phone_number':
+                        properties[notion_field] = {'phone_number': value}
+                    elif field_type == 'url':
+                        if not value.startswith(('http://', 'https://')):
+                            value = 'https://' + value
+                        properties[notion_field] = {'url': value}
+            
+            # Tipo di contatto
+            tipo = contact_field(row, mapping, 'tipo')
+            if tipo:
+                properties['Tipo di contatto'] = {
+                    'select': {'name': tipo}
+                }
+            
+            # Status default
+            properties['Status'] = {
+                'select': {'name': 'Contatto'}
+            }
+            
+            # Comune - passa l'email come hint per l'AI
+            result_info = {'success': False}
+            comune = contact_field(row, mapping, 'comune')
+            if comune:
+                # Risolto nella fase dei comuni; altrimenti ricerca con l'email come hint
+                key = (comune.lower(), email_domain(email))
+                if key in ctx.risoluzioni:
+                    comune_result = ctx.risoluzioni[key]
+                    # Gli span della risoluzione sono nella traccia della coppia
+                    trace_annotate(comune_risolto='fase_comuni')
+                else:
+                    with trace_stage('comune_resolve', comune=comune):
+                        comune_result = self.search_comune_on_notion(comune, ctx, email_hint=email)
+                
+                if comune_result:
+                    properties['Comune'] = {
+                        'relation': [{'id': comune_result['id']}]
+                    }
+                    if comune_result['nome'] != comune:
+                        result_info['comune_originale'] = comune
+                        result_info['comune_corretto'] = comune_result['nome']
+                else:
+                    result_info['comune_non_trovato'] = comune
+            
+            # Contatto esistente: aggiorna la pagina invece di crearne una nuova
+            if existing_id:
+                # Non sovrascrive lo Status gestito in Notion ne' il titolo (stessa email)
+                update = {k: v for k, v in properties.items()
+                          if k not in ('Status', 'Email primaria')}
+                with trace_stage('page_update'):
+                    notion_request('PATCH', f'pages/{existing_id}', {'properties': update},
+                                   timeout=30, stats=ctx.retry_stats)
+                result_info['success'] = True
+                result_info['updated'] = True
+                result_info['id'] = existing_id
+                return result_info
+            
+            # Crea in Notion
+            body = {
+                'parent': {'database_id': CONTATTI_DB_ID},
+                'properties': properties
+            }
+            
+            with trace_stage('page_create'):
+                notion_result = self.create_contact_page(body, email, ctx)
+            result_info['success'] = True
+            result_info['id'] = notion_result['id']
+            if reserved_email:
+                CONTATTI_INDEX.confirm(reserved_email, notion_result['id'])
+                reserved_email = None
+            return result_info
+                
+        except Exception as e:
+            return {'success': False, 'error': str(e)}
+        finally:
+            # Creazione non riuscita: l'email torna disponibile
+            if reserved_email:
+                CONTATTI_INDEX.release(reserved_email)
+    
+    def create_contact_page(self, body, email, ctx):
+        """Crea la pagina del contatto senza rischiare duplicati.
+
+        notion_request non ritenta la POST dopo un esito incerto (timeout,
+        connessione interrotta, 5xx): prima di un nuovo tentativo si verifica
+        in Contatti se la pagina con quell'email è stata comunque creata.
+        Questi errori e i retry vengono conteggiati qui nei RetryStats.
+        """
+        stats = ctx.retry_stats
+        for attempt in range(API_MAX_RETRIES + 1):
+            try:
+                return notion_request('POST', 'pages', body, timeout=30,
+                                      stats=stats, idempotent=False)
+            except APIError as e:
+                # 4xx o 429 esauriti (già conteggiati): la pagina non esiste
+                if not e.incerto:
+                    raise
+                if attempt >= API_MAX_RETRIES:
+                    stats.incr('failed')
+                    raise
+                stats.incr('server_errors' if e.status else 'timeouts')
+                existing = find_contatto_by_email(email, stats=stats)
+                if existing:
+                    print(f"[IMPORT] Contatto creato nonostante l'errore ({e}): {email}")
+                    return existing
+                stats.incr('retries')
+                delay = _retry_delay(attempt)
+                print(f"[RETRY] Notion: creazione {email} non riuscita ({e}), "
+                      f"nuovo tentativo {attempt + 1}/{API_MAX_RETRIES} tra {delay:.1f}s")
+                time.sleep(delay)
 
-# Tracking correzioni AI
-AI_CORRECTIONS = []
 
 class CSVImportHandler(BaseHTTPRequestHandler):
     def log_message(self, format, *args):
@@ -52,6 +2866,11 @@ class CSVImportHandler(BaseHTTPRequestHandler):
         timestamp = datetime.now().strftime('%H:%M:%S')
         print(f"[{timestamp}] {format % args}")
     
+    def handle_one_request(self):
+        """Conta le richieste in corso per /metrics"""
+        with METRICS.in_flight('csv_import_http_requests_in_flight'):
+            super().handle_one_request()
+    
     def end_headers(self):
         """Override per aggiungere sempre headers CORS"""
         self.send_header('Access-Control-Allow-Origin', '*')
@@ -67,7 +2886,9 @@ class CSVImportHandler(BaseHTTPRequestHandler):
     
     def do_GET(self):
         """Gestisce richieste GET"""
-        if self.path == '/':
+        path = urllib.parse.urlsplit(self.path).path
+        
+        if path == '/':
             try:
                 self.send_response(200)
                 self.send_header('Content-Type', 'text/html; charset=utf-8')
@@ -80,7 +2901,26 @@ class CSVImportHandler(BaseHTTPRequestHandler):
             except FileNotFoundError:
                 self.send_error(404, "File index.html non trovato")
                 
-        elif self.path == '/favicon.ico':
+        elif path.startswith('/jobs/'):
+            self.handle_job_request(path)
+                
+        elif path == '/comuni/status':
+            self.send_json_response({'success': True, 'index': COMUNI_INDEX.stats(),
+                                     'domini': DOMINI_INDEX.stats()})
+
+        elif path == '/comuni/cache':
+            self.send_json_response({'success': True, 'cache': RESOLUTION_STORE.stats()})
+
+        elif path == '/contatti/status':
+            self.send_json_response({'success': True, 'index': CONTATTI_INDEX.stats()})
+
+        elif path == '/pool/status':
+            self.send_json_response({'success': True, 'pool': HTTP_POOL.stats()})
+
+        elif path == '/metrics':
+            self.handle_metrics()
+
+        elif path == '/favicon.ico':
             self.send_response(204)  # No Content
             self.end_headers()
             
@@ -92,6 +2932,15 @@ class CSVImportHandler(BaseHTTPRequestHandler):
         try:
             print(f"[POST] Richiesta a: {self.path}")
             
+            # Upload CSV in streaming: il body non va letto tutto in memoria
+            parsed = urllib.parse.urlsplit(self.path)
+            if parsed.path == '/import-stream':
+                self.handle_import_stream(urllib.parse.parse_qs(parsed.query))
+                return
+            if parsed.path == '/csv/detect':
+                self.handle_csv_detect()
+                return
+            
             # Leggi il body
             content_length = int(self.headers.get('Content-Length', 0))
             post_data = self.rfile.read(content_length) if content_length > 0 else b''
@@ -111,6 +2960,10 @@ class CSVImportHandler(BaseHTTPRequestHandler):
                 self.handle_test_connection()
             elif self.path == '/parse-and-import':
                 self.handle_parse_and_import(data)
+            elif self.path == '/comuni/refresh':
+                self.handle_comuni_refresh()
+            elif self.path == '/comuni/cache/clear':
+                self.handle_cache_clear(data)
             else:
                 self.send_json_error(f"Endpoint '{self.path}' non trovato", 404)
                 
@@ -124,39 +2977,140 @@ class CSVImportHandler(BaseHTTPRequestHandler):
         print("[TEST] Test connessione Notion...")
         
         try:
-            headers = {
-                'Authorization': f'Bearer {NOTION_TOKEN}',
-                'Notion-Version': '2022-06-28'
-            }
+            data = notion_request('GET', 'users/me')
             
-            req = urllib.request.Request(
-                'https://api.notion.com/v1/users/me',
-                headers=headers
-            )
+            user_name = data.get('name', 'Utente sconosciuto')
+            user_type = data.get('type', 'Unknown')
             
-            with urllib.request.urlopen(req, timeout=10) as response:
-                data = json.loads(response.read().decode('utf-8'))
+            print(f"[TEST] ✅ Connessione OK - Utente: {user_name}")
+            
+            self.send_json_response({
+                'success': True,
+                'user': user_name,
+                'type': user_type
+            })
+                
+        except Exception as e:
+            error_msg = f"Errore connessione Notion: {str(e)}"
+            print(f"[TEST] ❌ {error_msg}")
+            self.send_json_error(error_msg, 500)
+    
+    def handle_metrics(self):
+        """GET /metrics in formato di esposizione Prometheus"""
+        METRICS.set('csv_import_comuni_index_entries', COMUNI_INDEX.stats()['comuni'])
+        METRICS.set('csv_import_contatti_index_entries', CONTATTI_INDEX.stats()['email'])
+        METRICS.set('csv_import_domini_index_entries', len(DOMINI_INDEX))
+        
+        payload = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+    
+    def handle_job_request(self, path):
+        """GET /jobs/<id> (stato), /jobs/<id>/events (Server-Sent Events)
+        e /jobs/<id>/trace (tracce delle righe in JSONL)"""
+        parts = path.strip('/').split('/')
+        if len(parts) == 3 and parts[2] == 'trace':
+            self.send_job_trace(parts[1])
+            return
+        job = get_job(parts[1]) if len(parts) > 1 else None
+        
+        if not job:
+            self.send_json_error("Job non trovato", 404)
+        elif len(parts) == 2:
+            self.send_json_response({'success': True, 'job': job.snapshot(include_results=True)})
+        elif len(parts) == 3 and parts[2] == 'events':
+            self.stream_job_events(job)
+        else:
+            self.send_json_error(f"Endpoint '{path}' non trovato", 404)
+    
+    def send_job_trace(self, job_id):
+        """Scarica il file JSONL delle tracce (disponibile anche dopo la fine del job)"""
+        if not re.fullmatch(r'[0-9a-f]{12}', job_id):
+            self.send_json_error("Job non trovato", 404)
+            return
+        trace_path = os.path.join(IMPORT_TRACE_DIR, f'{job_id}.jsonl')
+        if not os.path.exists(trace_path):
+            self.send_json_error("Traccia non disponibile per questo job", 404)
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+        self.send_header('Content-Disposition', f'attachment; filename="trace_{job_id}.jsonl"')
+        self.send_header('Content-Length', str(os.path.getsize(trace_path)))
+        self.end_headers()
+        with open(trace_path, 'rb') as f:
+            while True:
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+    
+    def stream_job_events(self, job):
+        """Invia l'avanzamento del job come stream SSE fino al completamento"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        
+        version = None
+        try:
+            while True:
+                new_version = job.wait_for_update(version, timeout=15)
                 
-                user_name = data.get('name', 'Utente sconosciuto')
-                user_type = data.get('type', 'Unknown')
+                if job.done:
+                    self.send_sse_event(job.status, job.snapshot(include_results=True))
+                    break
                 
-                print(f"[TEST] ✅ Connessione OK - Utente: {user_name}")
+                if new_version == version:
+                    # Heartbeat per non far chiudere la connessione dai proxy
+                    self.wfile.write(b': keep-alive\n\n')
+                    self.wfile.flush()
+                    continue
                 
-                self.send_json_response({
-                    'success': True,
-                    'user': user_name,
-                    'type': user_type
-                })
+                version = new_version
+                self.send_sse_event('progress', job.snapshot())
                 
+        except (BrokenPipeError, ConnectionResetError):
+            print(f"[SSE] Client disconnesso dal job {job.id}")
+    
+    def send_sse_event(self, event, data):
+        """Scrive un singolo evento SSE"""
+        payload = json.dumps(data, ensure_ascii=False)
+        self.wfile.write(f"event: {event}\ndata: {payload}\n\n".encode('utf-8'))
+        self.wfile.flush()
+    
+    def handle_comuni_refresh(self):
+        """Ricostruisce l'indice dei comuni senza riavviare il server"""
+        print("[INDEX] Ricaricamento indice comuni...")
+
+        try:
+            stats = COMUNI_INDEX.load()
+            self.send_json_response({'success': True, 'index': stats})
         except Exception as e:
-            error_msg = f"Errore connessione Notion: {str(e)}"
-            print(f"[TEST] ❌ {error_msg}")
+            error_msg = f"Errore caricamento comuni: {str(e)}"
+            print(f"[INDEX] ❌ {error_msg}")
             self.send_json_error(error_msg, 500)
-    
+
+    def handle_cache_clear(self, data):
+        """Invalida la cache persistente (tutta o solo un nome/dominio)"""
+        nome = data.get('nome')
+        dominio = data.get('dominio')
+        try:
+            removed = RESOLUTION_STORE.invalidate(
+                nome.strip().lower() if nome else None,
+                dominio.strip().lower() if dominio is not None else None
+            )
+            print(f"[CACHE] Voci rimosse: {removed}")
+            self.send_json_response({'success': True, 'rimosse': removed,
+                                     'cache': RESOLUTION_STORE.stats()})
+        except sqlite3.Error as e:
+            self.send_json_error(f"Errore cache: {str(e)}", 500)
+
     def handle_parse_and_import(self, data):
-        """Parse CSV e importa contatti"""
-        global COMUNI_CACHE, AI_CORRECTIONS
-        
+        """Parse CSV e avvia l'importazione dei contatti in background"""
         try:
             print("[IMPORT] === INIZIO IMPORTAZIONE ===")
             
@@ -180,121 +3134,53 @@ class CSVImportHandler(BaseHTTPRequestHandler):
             except Exception as e:
                 raise ValueError(f"Errore decodifica base64: {str(e)}")
             
-            # Prova encoding
-            text_content = None
-            for enc in ['utf-8', 'latin-1', 'iso-8859-1', 'cp1252']:
-                try:
-                    text_content = csv_content.decode(enc)
-                    print(f"[IMPORT] Encoding: {enc}")
-                    break
-                except UnicodeDecodeError:
-                    continue
-            
-            if not text_content:
-                raise ValueError("Impossibile decodificare CSV")
-            
-            # Parse CSV
-            text_content = text_content.replace('\r\n', '\n').replace('\r', '\n')
-            reader = csv.DictReader(io.StringIO(text_content))
-            rows = list(reader)
+            # Encoding e separatore da un campione, poi decodifica a blocchi in una passata
+            with trace_stage('csv_parse'):
+                csv_format = detect_csv_format(csv_content[:CSV_SAMPLE_SIZE])
+                text_stream = io.TextIOWrapper(io.BytesIO(csv_content), encoding=csv_format['encoding'],
+                                               errors='replace', newline='')
+                reader = csv.DictReader(text_stream, delimiter=csv_format['delimiter'],
+                                        quotechar=csv_format['quotechar'], restval='')
+                rows = list(reader)
+            print(f"[IMPORT] Formato: {csv_format}")
             
             if not rows:
                 raise ValueError("CSV vuoto")
                 
             print(f"[IMPORT] Righe da importare: {len(rows)}")
             
-            # Reset cache e tracking
-            COMUNI_CACHE = {}
-            AI_CORRECTIONS = []
-            
-            # Risultati
-            results = {
-                'success': 0,
-                'errors': [],
-                'comuni_corretti': [],
-                'comuni_non_trovati': [],
-                'contatti_non_importati': []  # Nuova lista per contatti completi non importati
+            options = {
+                'duplicati': data.get('duplicati'),
+                'file_hash': hashlib.sha256(csv_content).hexdigest(),
+                'resume': data.get('resume', True) is not False,
+                'trace': bool(data.get('trace'))
             }
             
-            # Import batch
-            batch_size = 5
-            for i in range(0, len(rows), batch_size):
-                batch = rows[i:i+batch_size]
-                batch_num = i // batch_size + 1
-                
-                print(f"[IMPORT] Batch {batch_num}: righe {i+1}-{min(i+batch_size, len(rows))}")
-                
-                for idx, row in enumerate(batch):
-                    row_num = i + idx + 1
-                    
-                    try:
-                        if row_num % 10 == 0:
-                            print(f"[IMPORT] Riga {row_num}/{len(rows)}")
-                        
-                        result = self.create_contact(row, mapping)
-                        
-                        if result.get('success'):
-                            results['success'] += 1
-                            
-                            if result.get('comune_corretto'):
-                                results['comuni_corretti'].append({
-                                    'originale': result['comune_originale'],
-                                    'corretto': result['comune_corretto']
-                                })
-                            elif result.get('comune_non_trovato'):
-                                if result['comune_non_trovato'] not in results['comuni_non_trovati']:
-                                    results['comuni_non_trovati'].append(result['comune_non_trovato'])
-                                
-                                # Aggiungi il contatto completo non importato
-                                contact_data = {}
-                                for field, column in mapping.items():
-                                    if column in row:
-                                        contact_data[field] = row[column].strip()
-                                contact_data['_comune_non_trovato'] = result['comune_non_trovato']
-                                contact_data['_row_number'] = row_num
-                                results['contatti_non_importati'].append(contact_data)
-                        else:
-                            results['errors'].append({
-                                'row': row_num,
-                                'error': result.get('error', 'Errore sconosciuto')
-                            })
-                            
-                            # Aggiungi anche agli errori il contatto completo
-                            contact_data = {}
-                            for field, column in mapping.items():
-                                if column in row:
-                                    contact_data[field] = row[column].strip()
-                            contact_data['_error'] = result.get('error', 'Errore sconosciuto')
-                            contact_data['_row_number'] = row_num
-                            if contact_data not in results['contatti_non_importati']:
-                                results['contatti_non_importati'].append(contact_data)
-                            
-                    except Exception as e:
-                        print(f"[IMPORT] Errore riga {row_num}: {e}")
-                        results['errors'].append({
-                            'row': row_num,
-                            'error': str(e)
-                        })
-                
-                # Pausa tra batch
-                if i + batch_size < len(rows):
-                    time.sleep(2)
-            
-            print(f"[IMPORT] === COMPLETATO ===")
-            print(f"[IMPORT] Successi: {results['success']}")
-            print(f"[IMPORT] Errori: {len(results['errors'])}")
-            
-            # Aggiungi correzioni AI ai risultati
-            if AI_CORRECTIONS:
-                print(f"\n[AI] === CORREZIONI CON INTELLIGENZA ARTIFICIALE ===")
-                print(f"[AI] Totale correzioni: {len(AI_CORRECTIONS)}")
-                for corr in AI_CORRECTIONS:
-                    print(f"[AI] {corr['timestamp']} - '{corr['originale']}' → '{corr['corretto']}'")
-                results['ai_corrections'] = AI_CORRECTIONS
+            # Simulazione: nessuna pagina creata, ritorna subito il piano
+            if data.get('dry_run'):
+                self.send_json_response({
+                    'success': True,
+                    'dry_run': True,
+                    'formato': csv_format,
+                    'plan': ContactImporter().plan_import(rows, mapping, options)
+                })
+                return
             
+            # Import in background: la richiesta ritorna subito con l'id del job
+            job = ImportJob(len(rows))
+            register_job(job)
+            threading.Thread(
+                target=ContactImporter().run_import_job,
+                args=(job, rows, mapping, None, options),
+                daemon=True
+            ).start()
+            
+            print(f"[IMPORT] Job {job.id} avviato ({len(rows)} righe)")
             self.send_json_response({
                 'success': True,
-                'results': results
+                'job_id': job.id,
+                'total': len(rows),
+                'formato': csv_format
             })
             
         except Exception as e:
@@ -303,383 +3189,158 @@ class CSVImportHandler(BaseHTTPRequestHandler):
             traceback.print_exc()
             self.send_json_error(error_msg, 500)
     
-    def extract_comune_from_email(self, email):
-        """Estrae il possibile nome del comune dall'email"""
-        if not email:
-            return None
-            
-        email_lower = email.lower()
-        
-        # Pattern comuni per email istituzionali
-        patterns = [
-            r'@comune\.([^.]+)\.',  # @comune.barzano.lc.it
-            r'@comunedi([^.@]+)\.',  # @comunedibarzano.it
-            r'@comune-([^.]+)\.',    # @comune-barzano.it
-            r'comune\.([^.@]+)@',    # comune.barzano@...
-            r'@([^.]+)\.gov\.it',    # @barzano.gov.it
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, email_lower)
-            if match:
-                comune = match.group(1)
-                # Rimuovi caratteri speciali e capitalizza
-                comune = comune.replace('-', ' ').replace('_', ' ')
-                comune = ' '.join(word.capitalize() for word in comune.split())
-                print(f"[EMAIL] Estratto comune dall'email: {comune}")
-                return comune
-                
-        return None
-    
-    def search_comune_with_openai(self, nome_originale, email_hint=None):
-        """Usa OpenAI per trovare varianti del nome comune"""
-        if not OPENAI_API_KEY or not OPENAI_API_KEY.startswith('sk-'):
-            return None
-            
-        # Prima prova a estrarre il comune dall'email
-        if email_hint:
-            extracted_comune = self.extract_comune_from_email(email_hint)
-            if extracted_comune:
-                print(f"[OPENAI] Provo prima con comune estratto dall'email: {extracted_comune}")
-                # Verifica se il comune estratto esiste
-                test_result = self.search_comune_on_notion_direct(extracted_comune)
-                if test_result:
-                    print(f"[OPENAI] Comune trovato dall'email: {extracted_comune}")
-                    AI_CORRECTIONS.append({
-                        'originale': nome_originale,
-                        'corretto': extracted_comune,
-                        'timestamp': datetime.now().strftime('%H:%M:%S'),
-                        'metodo': 'email'
-                    })
-                    return extracted_comune
-        
-        try:
-            headers = {
-                'Authorization': f'Bearer {OPENAI_API_KEY}',
-                'Content-Type': 'application/json'
-            }
-            
-            # Aggiungi hint dall'email se disponibile
-            email_info = ""
-            if email_hint:
-                email_info = f"\nEmail associata (potrebbe contenere il nome del comune): {email_hint}"
-            
-            prompt = f"""Il seguente nome di comune italiano potrebbe avere errori di battitura, abbreviazioni o varianti.
-Fornisci SOLO il nome corretto del comune italiano, senza spiegazioni aggiuntive.
-Se non è un comune italiano valido, rispondi solo con "NON_TROVATO".
-
-Nome da correggere: {nome_originale}{email_info}
-
-Esempi di correzioni:
-- "S. Giovanni" → "San Giovanni"
-- "Barzano'" → "Barzanò"
-- "Male'" → "Malè"
-- "Baselga Di Pine'" → "Baselga di Pinè"
-
-Se l'email contiene "comune.barzano" o simili, il comune è probabilmente "Barzanò".
+    def handle_import_stream(self, query):
+        """Importazione da upload CSV grezzo (text/csv) letto a blocchi dal socket.
 
-Risposta:"""
-            
-            body = {
-                'model': 'gpt-4o-mini',  # Cambiato a modello esistente
-                'messages': [
-                    {'role': 'system', 'content': 'Sei un esperto di geografia italiana. Rispondi SOLO con il nome corretto del comune o "NON_TROVATO".'},
-                    {'role': 'user', 'content': prompt}
-                ],
-                'temperature': 0.1,
-                'max_tokens': 50
-            }
-            
-            req = urllib.request.Request(
-                'https://api.openai.com/v1/chat/completions',
-                data=json.dumps(body).encode('utf-8'),
-                headers=headers,
-                method='POST'
-            )
-            
-            with urllib.request.urlopen(req, timeout=10) as response:
-                data = json.loads(response.read().decode('utf-8'))
-                suggested_name = data['choices'][0]['message']['content'].strip()
-                
-                if suggested_name and suggested_name != 'NON_TROVATO':
-                    print(f"[OPENAI] Suggerimento per '{nome_originale}': '{suggested_name}'")
-                    # Registra la correzione
-                    AI_CORRECTIONS.append({
-                        'originale': nome_originale,
-                        'corretto': suggested_name,
-                        'timestamp': datetime.now().strftime('%H:%M:%S')
-                    })
-                    return suggested_name
-                    
-            return None
-            
-        except urllib.error.HTTPError as e:
-            error_body = e.read().decode('utf-8') if e.read() else 'No error body'
-            print(f"[OPENAI] Errore HTTP {e.code}: {e.reason}")
-            print(f"[OPENAI] Dettagli: {error_body}")
-            
-            # Se il problema è il modello, suggerisci alternative
-            if 'model' in error_body.lower():
-                print("[OPENAI] Nota: Il modello potrebbe non essere disponibile. Modelli validi: gpt-4o-mini, gpt-4o, gpt-3.5-turbo")
-            return None
-        except Exception as e:
-            print(f"[OPENAI] Errore generico: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
-    
-    def search_comune_on_notion(self, nome, email_hint=None):
-        """Cerca comune su Notion"""
-        global COMUNI_CACHE
-        
-        if not nome or not nome.strip():
-            return None
-            
-        nome = nome.strip()
-        nome_lower = nome.lower()
-        
-        # Cache check
-        if nome_lower in COMUNI_CACHE:
-            return COMUNI_CACHE[nome_lower]
-        
+        Il mapping arriva nella query string (`?mapping=<json>`). Il body viene
+        copiato su un file temporaneo man mano che arriva; il job in background
+        legge poi le righe una alla volta, quindi la memoria non dipende dalla
+        dimensione del file.
+        """
+        spool_path = None
         try:
-            headers = {
-                'Authorization': f'Bearer {NOTION_TOKEN}',
-                'Notion-Version': '2022-06-28',
-                'Content-Type': 'application/json'
-            }
+            print("[IMPORT] === INIZIO IMPORTAZIONE (streaming) ===")
             
-            # Ricerca esatta
-            body = {
-                'filter': {
-                    'property': 'Name',
-                    'title': {'equals': nome}
-                },
-                'page_size': 1
-            }
+            try:
+                mapping = json.loads(query.get('mapping', [''])[0] or 'null')
+            except json.JSONDecodeError:
+                raise ValueError("Mapping non valido")
             
-            req = urllib.request.Request(
-                f'https://api.notion.com/v1/databases/{COMUNI_DB_ID}/query',
-                data=json.dumps(body).encode('utf-8'),
-                headers=headers,
-                method='POST'
-            )
+            if not mapping:
+                raise ValueError("Mapping mancante")
+            if not mapping.get('email'):
+                raise ValueError("Mapping email primaria mancante")
             
-            with urllib.request.urlopen(req, timeout=10) as response:
-                data = json.loads(response.read().decode('utf-8'))
-                if data['results']:
-                    comune_id = data['results'][0]['id']
-                    comune_nome = data['results'][0]['properties']['Name']['title'][0]['plain_text']
-                    COMUNI_CACHE[nome_lower] = {'id': comune_id, 'nome': comune_nome}
-                    print(f"[COMUNE] ✓ Trovato: {comune_nome}")
-                    return {'id': comune_id, 'nome': comune_nome}
+            print(f"[IMPORT] Mapping: {mapping}")
             
-            # Ricerca fuzzy
-            body = {
-                'filter': {
-                    'property': 'Name',
-                    'title': {'contains': nome}
-                },
-                'page_size': 10
-            }
+            # Copia il body su disco a blocchi
+            fd, spool_path = tempfile.mkstemp(prefix='import_', suffix='.csv')
+            size = 0
+            sample = b''
+            file_hash = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as spool, \
+                    trace_stage('csv_upload'):
+                for chunk in self.iter_request_body():
+                    file_hash.update(chunk)
+                    if len(sample) < CSV_SAMPLE_SIZE:
+                        sample += chunk[:CSV_SAMPLE_SIZE - len(sample)]
+                    spool.write(chunk)
+                    size += len(chunk)
             
-            req = urllib.request.Request(
-                f'https://api.notion.com/v1/databases/{COMUNI_DB_ID}/query',
-                data=json.dumps(body).encode('utf-8'),
-                headers=headers,
-                method='POST'
-            )
+            if not size:
+                raise ValueError("CSV vuoto")
             
-            with urllib.request.urlopen(req, timeout=10) as response:
-                data = json.loads(response.read().decode('utf-8'))
-                
-                # Match case-insensitive
-                for result in data['results']:
-                    comune_nome = result['properties']['Name']['title'][0]['plain_text']
-                    if comune_nome.lower() == nome_lower:
-                        comune_id = result['id']
-                        COMUNI_CACHE[nome_lower] = {'id': comune_id, 'nome': comune_nome}
-                        print(f"[COMUNE] ✓ Trovato (fuzzy): {comune_nome}")
-                        return {'id': comune_id, 'nome': comune_nome}
-                
-                # Best match
-                if len(data['results']) == 1:
-                    result = data['results'][0]
-                    comune_id = result['id']
-                    comune_nome = result['properties']['Name']['title'][0]['plain_text']
-                    COMUNI_CACHE[nome_lower] = {'id': comune_id, 'nome': comune_nome}
-                    print(f"[COMUNE] ✓ Trovato (unico): {comune_nome}")
-                    return {'id': comune_id, 'nome': comune_nome}
+            csv_format = detect_csv_format(sample)
+            print(f"[IMPORT] CSV ricevuto: {size} bytes, formato: {csv_format}")
             
-            # Se non trovato, prova con OpenAI per trovare varianti
-            print(f"[COMUNE] Non trovato direttamente, provo con OpenAI: {nome}")
-            if email_hint:
-                print(f"[COMUNE] Email hint: {email_hint}")
-            suggested_name = self.search_comune_with_openai(nome, email_hint)
-            
-            if suggested_name:
-                # Riprova la ricerca con il nome suggerito
-                print(f"[COMUNE] Riprovo con nome suggerito: {suggested_name}")
-                suggested_result = self.search_comune_on_notion_direct(suggested_name)
-                if suggested_result:
-                    COMUNI_CACHE[nome_lower] = suggested_result
-                    return suggested_result
-            
-            print(f"[COMUNE] ✗ Non trovato: {nome}")
-            COMUNI_CACHE[nome_lower] = None
-            return None
+            # Conteggio righe (lettura in streaming) per avanzamento ed ETA
+            rows = CSVFileRows.from_format(spool_path, csv_format)
+            with trace_stage('csv_parse'):
+                total = sum(1 for _ in rows)
+            if not total:
+                raise ValueError("CSV vuoto")
             
-        except Exception as e:
-            print(f"[COMUNE] Errore: {e}")
-            return None
-    
-    def search_comune_on_notion_direct(self, nome):
-        """Ricerca diretta su Notion senza cache o OpenAI"""
-        try:
-            headers = {
-                'Authorization': f'Bearer {NOTION_TOKEN}',
-                'Notion-Version': '2022-06-28',
-                'Content-Type': 'application/json'
-            }
+            print(f"[IMPORT] Righe da importare: {total}")
             
-            # Ricerca esatta
-            body = {
-                'filter': {
-                    'property': 'Name',
-                    'title': {'equals': nome}
-                },
-                'page_size': 1
+            options = {
+                'duplicati': query.get('duplicati', [None])[0],
+                'file_hash': file_hash.hexdigest(),
+                'resume': query.get('resume', ['1'])[0] not in ('0', 'false'),
+                'trace': query.get('trace', ['0'])[0] not in ('0', 'false')
             }
             
-            req = urllib.request.Request(
-                f'https://api.notion.com/v1/databases/{COMUNI_DB_ID}/query',
-                data=json.dumps(body).encode('utf-8'),
-                headers=headers,
-                method='POST'
-            )
+            # Simulazione: il file temporaneo viene rimosso nel finally
+            if query.get('dry_run', ['0'])[0] not in ('0', 'false'):
+                self.send_json_response({
+                    'success': True,
+                    'dry_run': True,
+                    'formato': csv_format,
+                    'plan': ContactImporter().plan_import(rows, mapping, options)
+                })
+                return
             
-            with urllib.request.urlopen(req, timeout=10) as response:
-                data = json.loads(response.read().decode('utf-8'))
-                if data['results']:
-                    comune_id = data['results'][0]['id']
-                    comune_nome = data['results'][0]['properties']['Name']['title'][0]['plain_text']
-                    print(f"[COMUNE] ✓ Trovato con OpenAI: {nome} → {comune_nome}")
-                    return {'id': comune_id, 'nome': comune_nome}
+            job = ImportJob(total)
+            register_job(job)
+            threading.Thread(
+                target=ContactImporter().run_import_job,
+                args=(job, rows, mapping, spool_path, options),
+                daemon=True
+            ).start()
+            spool_path = None  # ora è il job a rimuovere il file
             
-            return None
+            print(f"[IMPORT] Job {job.id} avviato ({total} righe)")
+            self.send_json_response({
+                'success': True,
+                'job_id': job.id,
+                'total': total,
+                'formato': csv_format
+            })
             
         except Exception as e:
-            print(f"[COMUNE] Errore ricerca diretta: {e}")
-            return None
+            error_msg = str(e)
+            print(f"[IMPORT] ❌ Errore: {error_msg}")
+            self.send_json_error(error_msg, 400 if isinstance(e, ValueError) else 500)
+        finally:
+            if spool_path and os.path.exists(spool_path):
+                os.remove(spool_path)
+    
+    def handle_csv_detect(self):
+        """Rileva formato e intestazioni dall'inizio del file (body text/csv).
 
-    def create_contact(self, row, mapping):
-        """Crea contatto in Notion"""
+        Basta inviare i primi CSV_SAMPLE_SIZE byte: il resto viene ignorato.
+        """
         try:
-            # Email obbligatoria
-            email_column = mapping.get('email', '')
-            email = row.get(email_column, '').strip() if email_column else ''
-            
-            if not email:
-                return {'success': False, 'error': f'Email mancante'}
-            
-            # Proprietà base
-            properties = {
-                'Email primaria': {
-                    'title': [{'text': {'content': email}}]
-                }
-            }
+            sample = b''
+            for chunk in self.iter_request_body():
+                if len(sample) < CSV_SAMPLE_SIZE:
+                    sample += chunk[:CSV_SAMPLE_SIZE - len(sample)]
             
-            # Altri campi
-            field_mapping = {
-                'nome': ('Nome e cognome', 'rich_text'),
-                'carica': ('Carica', 'rich_text'),
-                'indirizzo': ('Indirizzo', 'rich_text'),
-                'email2': ('Email 2', 'email'),
-                'email3': ('Email 3', 'email'),
-                'telefono': ('Telefono', 'phone_number'),
-                'cellulare': ('Cellulare', 'phone_number'),
-                'sito': ('Sito web', 'url'),
-            }
-            
-            for field, (notion_field, field_type) in field_mapping.items():
-                if field in mapping and mapping[field] in row:
-                    value = row[mapping[field]].strip()
-                    if value:
-                        if field_type == 'rich_text':
-                            properties[notion_field] = {
-                                'rich_text': [{'text': {'content': value}}]
-                            }
-                        elif field_type == 'email' and '@' in value:
-                            properties[notion_field] = {'email': value}
-                        elif field_type == 'phone_number':
-                            properties[notion_field] = {'phone_number': value}
-                        elif field_type == 'url':
-                            if not value.startswith(('http://', 'https://')):
-                                value = 'https://' + value
-                            properties[notion_field] = {'url': value}
-            
-            # Tipo di contatto
-            if 'tipo' in mapping and mapping['tipo'] in row:
-                tipo = row[mapping['tipo']].strip()
-                if tipo:
-                    properties['Tipo di contatto'] = {
-                        'select': {'name': tipo}
-                    }
-            
-            # Status default
-            properties['Status'] = {
-                'select': {'name': 'Contatto'}
-            }
-            
-            # Comune - passa l'email come hint per l'AI
-            result_info = {'success': False}
-            if 'comune' in mapping and mapping['comune'] in row:
-                comune = row[mapping['comune']].strip()
-                if comune:
-                    # Passa l'email come hint per aiutare l'AI
-                    comune_result = self.search_comune_on_notion(comune, email_hint=email)
-                    
-                    if comune_result:
-                        properties['Comune'] = {
-                            'relation': [{'id': comune_result['id']}]
-                        }
-                        if comune_result['nome'] != comune:
-                            result_info['comune_originale'] = comune
-                            result_info['comune_corretto'] = comune_result['nome']
-                    else:
-                        result_info['comune_non_trovato'] = comune
-            
-            # Crea in Notion
-            headers = {
-                'Authorization': f'Bearer {NOTION_TOKEN}',
-                'Notion-Version': '2022-06-28',
-                'Content-Type': 'application/json'
-            }
-            
-            body = {
-                'parent': {'database_id': CONTATTI_DB_ID},
-                'properties': properties
-            }
-            
-            req = urllib.request.Request(
-                'https://api.notion.com/v1/pages',
-                data=json.dumps(body).encode('utf-8'),
-                headers=headers,
-                method='POST'
-            )
+            if not sample.strip():
+                raise ValueError("CSV vuoto")
             
-            with urllib.request.urlopen(req, timeout=30) as response:
-                if response.status == 200:
-                    notion_result = json.loads(response.read().decode('utf-8'))
-                    result_info['success'] = True
-                    result_info['id'] = notion_result['id']
-                    return result_info
-                else:
-                    error_text = response.read().decode('utf-8')
-                    return {'success': False, 'error': f'HTTP {response.status}'}
-                
+            csv_format = detect_csv_format(sample)
+            headers = csv_headers(sample, csv_format)
+            print(f"[CSV] Formato rilevato: {csv_format}, {len(headers)} colonne")
+            self.send_json_response({
+                'success': True,
+                'formato': csv_format,
+                'headers': headers
+            })
         except Exception as e:
-            return {'success': False, 'error': str(e)}
+            print(f"[CSV] ❌ Errore: {e}")
+            self.send_json_error(str(e), 400 if isinstance(e, ValueError) else 500)
+    
+    def iter_request_body(self):
+        """Legge il body della richiesta a blocchi (Content-Length o chunked)"""
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                line = self.rfile.readline()
+                # Riga vuota (connessione chiusa) o non esadecimale: upload troncato
+                try:
+                    chunk_size = int(line.split(b';')[0].strip(), 16)
+                except ValueError:
+                    raise ValueError("Upload interrotto")
+                if chunk_size == 0:
+                    # Trailer opzionali fino alla riga vuota
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                remaining = chunk_size
+                while remaining > 0:
+                    data = self.rfile.read(min(remaining, UPLOAD_CHUNK_SIZE))
+                    if not data:
+                        raise ValueError("Upload interrotto")
+                    remaining -= len(data)
+                    yield data
+                self.rfile.readline()  # CRLF dopo ogni chunk
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                data = self.rfile.read(min(remaining, UPLOAD_CHUNK_SIZE))
+                if not data:
+                    raise ValueError("Upload interrotto")
+                remaining -= len(data)
+                yield data
     
     def send_json_response(self, data):
         """Invia risposta JSON"""
@@ -718,8 +3379,160 @@ Risposta:"""
         except Exception as e:
             print(f"[ERROR] Errore invio errore: {e}")
 
+# Intervallo (secondi) tra due righe di avanzamento dell'import da riga di comando
+CLI_PROGRESS_INTERVAL = float(os.environ.get("CLI_PROGRESS_INTERVAL", "2"))
+
+# Colonne del CSV dei contatti non importati (come l'export dell'interfaccia web)
+NON_IMPORTATI_COLUMNS = [
+    ('Riga', '_row_number'), ('Email primaria', 'email'), ('Nome e cognome', 'nome'),
+    ('Carica', 'carica'), ('Indirizzo', 'indirizzo'), ('Email 2', 'email2'), ('Email 3', 'email3'),
+    ('Telefono', 'telefono'), ('Cellulare', 'cellulare'), ('Sito web', 'sito'),
+    ('Tipo contatto', 'tipo'), ('Comune', 'comune'),
+]
+
+
+def write_non_importati_csv(path, contatti):
+    """Scrive i contatti non importati con il motivo (colonna Problema)"""
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f)
+        writer.writerow([nome for nome, _ in NON_IMPORTATI_COLUMNS] + ['Problema'])
+        for contact in contatti:
+            if contact.get('_comune_non_trovato'):
+                problema = f"Comune non trovato: {contact['_comune_non_trovato']}"
+            else:
+                problema = contact.get('_error') or 'Errore sconosciuto'
+            writer.writerow([contact.get(campo, '') for _, campo in NON_IMPORTATI_COLUMNS] + [problema])
+
+
+def print_cli_progress(job):
+    """Stampa l'avanzamento del job finché non termina"""
+    version = 0
+    last = 0
+    while not job.done:
+        version = job.wait_for_update(version, CLI_PROGRESS_INTERVAL)
+        if job.done or time.monotonic() - last < CLI_PROGRESS_INTERVAL:
+            continue
+        last = time.monotonic()
+        snap = job.snapshot()
+        eta = f"{snap['eta_seconds']}s" if snap['eta_seconds'] is not None else '-'
+        if snap['fase'] == 'comuni':
+            print(f"[CLI] Risoluzione dei comuni ({snap['elapsed']}s)", flush=True)
+            continue
+        print(f"[CLI] {snap['processed']}/{snap['total']} righe · {snap['rows_per_sec']} righe/s · "
+              f"successi {snap['success']} · errori {snap['errors']} · ETA {eta}", flush=True)
+
+
+def cli_import(argv):
+    """Importazione da riga di comando: `python server.py import FILE --mapping mapping.json`.
+
+    Il CSV viene letto dal disco in streaming (CSVFileRows) e passa per la
+    stessa pipeline del server (run_import), senza browser né richieste HTTP.
+    Il report completo viene scritto in JSON, i contatti non importati in CSV.
+    Ritorna il codice di uscita.
+    """
+    parser = argparse.ArgumentParser(
+        prog='server.py import', description='Importa un CSV di contatti in Notion')
+    parser.add_argument('file', help='CSV da importare')
+    parser.add_argument('--mapping', required=True,
+                        help='file JSON con il mapping campo → colonna (es. {"email": "EMAIL", "comune": "COMUNE"})')
+    parser.add_argument('--duplicati', choices=DUPLICATI_MODES, default='skip',
+                        help='contatti già presenti: skip, update o import (default: skip)')
+    parser.add_argument('--dry-run', action='store_true', help='simula senza scrivere su Notion')
+    parser.add_argument('--no-resume', action='store_true',
+                        help="riparte da zero anche se un'importazione dello stesso file si è interrotta")
+    parser.add_argument('--trace', action='store_true', help='registra le tracce delle righe')
+    parser.add_argument('--report', help='report JSON (default: <file>_report.json)')
+    parser.add_argument('--report-csv', help='CSV dei contatti non importati (default: <file>_non_importati.csv)')
+    args = parser.parse_args(argv)
+    
+    if not NOTION_TOKEN or not CONTATTI_DB_ID:
+        print("❌ ERRORE: NOTION_TOKEN e CONTATTI_DB_ID devono essere configurati")
+        return 1
+    
+    with open(args.mapping, 'r', encoding='utf-8') as f:
+        mapping = json.load(f)
+    if not isinstance(mapping, dict) or not mapping.get('email'):
+        print("❌ ERRORE: mapping email primaria mancante")
+        return 1
+    
+    # Formato dal campione iniziale, hash del file per il journal e conteggio righe
+    file_hash = hashlib.sha256()
+    sample = b''
+    with open(args.file, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            if len(sample) < CSV_SAMPLE_SIZE:
+                sample += chunk[:CSV_SAMPLE_SIZE - len(sample)]
+            file_hash.update(chunk)
+    csv_format = detect_csv_format(sample)
+    rows = CSVFileRows.from_format(args.file, csv_format)
+    total = sum(1 for _ in rows)
+    print(f"[CLI] {args.file}: {total} righe, formato: {csv_format}")
+    if not total:
+        print("❌ ERRORE: CSV vuoto")
+        return 1
+    
+    missing = [column for column in mapping.values()
+               if column and column not in csv_headers(sample, csv_format)]
+    if missing:
+        print(f"❌ ERRORE: colonne del mapping non presenti nel CSV: {missing}")
+        return 1
+    
+    options = {
+        'duplicati': args.duplicati,
+        'file_hash': file_hash.hexdigest(),
+        'resume': not args.no_resume,
+        'trace': args.trace
+    }
+    
+    importer = ContactImporter()
+    base = os.path.splitext(os.path.basename(args.file))[0]
+    report_path = args.report or f'{base}_report.json'
+    
+    if args.dry_run:
+        plan = importer.plan_import(rows, mapping, options)
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump({'dry_run': True, 'formato': csv_format, 'plan': plan}, f, ensure_ascii=False, indent=2)
+        print(f"[CLI] Simulazione: {plan['righe']}")
+        print(f"[CLI] Chiamate previste: {plan['chiamate_previste']}, ETA {plan['eta_secondi']}s")
+        print(f"[CLI] Piano scritto in {report_path}")
+        return 0
+    
+    job = ImportJob(total)
+    worker = threading.Thread(target=importer.run_import_job,
+                              args=(job, rows, mapping, None, options), daemon=True)
+    worker.start()
+    try:
+        print_cli_progress(job)
+    except KeyboardInterrupt:
+        print("\n[CLI] Interrotto: rilanciando lo stesso comando l'importazione riprende dal journal")
+        return 130
+    worker.join()
+    
+    snap = job.snapshot()
+    if job.status == 'failed':
+        print(f"❌ Importazione fallita: {job.error}")
+        return 1
+    
+    results = job.results
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({'file': args.file, 'formato': csv_format, 'job': snap, 'results': results},
+                  f, ensure_ascii=False, indent=2)
+    csv_path = args.report_csv or f'{base}_non_importati.csv'
+    write_non_importati_csv(csv_path, results['contatti_non_importati'])
+    
+    print(f"[CLI] Completato in {snap['elapsed']}s ({snap['rows_per_sec']} righe/s): "
+          f"{results['success']} importati, {results['saltati_esistenti']} già presenti, "
+          f"{len(results['errors'])} errori")
+    print(f"[CLI] Report: {report_path}")
+    print(f"[CLI] Contatti non importati ({len(results['contatti_non_importati'])}): {csv_path}")
+    return 0
+
+
 def main():
-    """Avvia il server"""
+    """Avvia il server (o l'importazione da riga di comando con `import`)"""
+    if len(sys.argv) > 1 and sys.argv[1] == 'import':
+        sys.exit(cli_import(sys.argv[2:]))
+    
     # Verifica configurazione
     if not NOTION_TOKEN:
         print("❌ ERRORE: NOTION_TOKEN non configurato!")
@@ -736,10 +3549,15 @@ def main():
     else:
         print("ℹ️  OpenAI non configurato (opzionale)")
     
+    # Precarica l'indice comuni (disattivabile con COMUNI_PRELOAD=0)
+    if COMUNI_DB_ID and os.environ.get('COMUNI_PRELOAD', '1') != '0':
+        COMUNI_INDEX.ensure_loaded()
+    
     # Avvia server - usa PORT da ambiente per Render
     port = int(os.environ.get('PORT', 8000))
     # Bind a 0.0.0.0 per Render (non localhost)
-    server = HTTPServer(('0.0.0.0', port), CSVImportHandler)
+    # Un thread per richiesta (necessario per gli stream SSE)
+    server = ThreadingHTTPServer(('0.0.0.0', port), CSVImportHandler)
     
     print('=' * 60)
     print('🚀 CSV Import Server - VERSIONE FINALE')